@@ -0,0 +1,226 @@
+# Compile all the blocks of a merged circuit to pulses on a local process pool
+import os
+import glob
+import time
+import hashlib
+import multiprocessing
+import numpy as np
+import h5py
+
+from quantum_optimal_control.main_grape.grape import Grape
+from quantum_optimal_control.main_grape.continuation import find_min_time
+from quantum_optimal_control.helper_functions.grape_functions import concerned
+from quantum_optimal_control.helper_functions.data_management import H5File
+from quantum_optimal_control.helper_functions.pulse_library import PulseLibrary, resample_pulses
+from quantum_optimal_control.compilation.hamiltonian import xy_hamiltonian_2D
+
+
+def default_hamiltonian(qubit_num, mapping):
+    # control Hamiltonian of a block, same as gen_pulse.run_circuit
+    return xy_hamiltonian_2D(qubit_num, 2, 5, 1, mapping)
+
+
+def block_mapping(qc, block):
+    # coupling map positions of the wires of a block, shifted to the origin.
+    # Without a mapping the wires are taken as a line
+    if len(qc.mapping) == 0:
+        return [(0, ii) for ii in range(len(block.wires))]
+    mapping = [qc.mapping[qc.wires.index(wire)] for wire in block.wires]
+    row_min = min([row for row, col in mapping])
+    col_min = min([col for row, col in mapping])
+    return [(row - row_min, col - col_min) for row, col in mapping]
+
+
+def block_key(U, mapping):
+    # blocks with the same unitary on the same coupling geometry share their pulse
+    U = np.round(np.array(U, dtype=complex), 8) + 0.
+    return hashlib.sha1(repr(mapping) + U.tostring()).hexdigest()
+
+
+def find_compiled_block(data_path, file_name):
+    # result of a finished optimization of a block in data_path, None if there is none
+    for file_path in sorted(glob.glob(os.path.join(data_path, '*_' + file_name + '.h5'))):
+        with h5py.File(file_path, 'r') as hf:
+            if 'block_compiled' in hf:
+                return {'uks': np.array(hf['uks'][-1]), 'error': float(hf['error'][-1]), 'file_path': file_path}
+    return None
+
+
+def circuit_jobs(qc, job_args):
+    # one job for each distinct block of qc, and the key of the block of each gate
+    keys = []
+    jobs = {}
+    for block in qc.op_tab:
+        mapping = block_mapping(qc, block)
+        U = block.unitary()
+        key = block_key(U, mapping)
+        keys.append(key)
+        if key not in jobs:
+            jobs[key] = dict(job_args, key=key, U=U, mapping=mapping)
+    return keys, jobs
+
+
+def run_jobs(function, pending, processes):
+    # run function on the pending jobs on a process pool, the outputs are yielded as the jobs finish
+    pool = multiprocessing.Pool(min(processes, len(pending)))
+    try:
+        for output in pool.imap_unordered(function, pending):
+            yield output
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def block_hamiltonian(job):
+    # drift and control Hamiltonians of a block
+    qubit_num = len(job['mapping'])
+    Hops, Hnames, maxA = job['hamiltonian'](qubit_num, job['mapping'])
+    return np.identity(2**qubit_num), Hops, Hnames, maxA
+
+
+def compile_block(job):
+    # run GRAPE for one block, job is a dictionary built by compile_circuit
+    start_time = time.time()
+    qubit_num = len(job['mapping'])
+    H0, Hops, Hnames, maxA = block_hamiltonian(job)
+
+    args = {'show_plots': False, 'use_gpu': False, 'sparse_H': False, 'method': 'ADAM'}
+    args.update(job['grape_args'])
+    args.update({'maxA': maxA, 'save': True, 'file_name': job['file_name'], 'data_path': job['data_path'],
+                 'num_threads': job['threads'], 'cache_graph': True})
+    uks, U_final, result = Grape(H0, Hops, Hnames, job['U'], job['total_time'], job['steps'], concerned(qubit_num, 2),
+                                 return_file_path=True, **args)
+
+    # mark the file as finished, so a later run of compile_circuit can resume from it
+    with H5File(result) as hf:
+        hf.add('block_compiled', data=True)
+        error = float(hf['error'][-1])
+
+    return job['key'], {'uks': np.array(uks), 'error': error, 'file_path': result}, time.time() - start_time
+
+
+def min_time_block(job):
+    # find the shortest gate time of one block, job is a dictionary built by circuit_min_times
+    start_time = time.time()
+    qubit_num = len(job['mapping'])
+    H0, Hops, Hnames, maxA = block_hamiltonian(job)
+
+    args = {'show_plots': False, 'use_gpu': False, 'sparse_H': False, 'method': 'ADAM'}
+    args.update(job['grape_args'])
+    args.update({'maxA': maxA, 'save': False, 'num_threads': job['threads']})
+    result = find_min_time(H0, Hops, Hnames, job['U'], job['max_time'], job['steps'], concerned(qubit_num, 2),
+                           min_time=job['min_time'], time_tolerance=job['time_tolerance'], **args)
+    return job['key'], result, time.time() - start_time
+
+
+def compile_circuit(qc, total_time, steps, data_path, file_name='block', grape_args=None,
+                    hamiltonian=default_hamiltonian, processes=None, threads_per_worker=1, resume=True,
+                    library=None, library_tolerance=1e-6):
+    """
+    - Compile the blocks of qc, after block_merge, to pulses on a pool of worker processes.
+    - Identical blocks are optimized once, and blocks with a finished file in data_path are not optimized again
+      when resume is True.
+    - library is the file path of a PulseLibrary. Blocks found in the library within library_tolerance are not
+      optimized when their pulses reached the conv_target, otherwise the nearest pulses in the library are used
+      as initial guess.
+      The compiled blocks are added to the library by this process, a pulse_library in grape_args is used as library
+      instead of being passed to the workers.
+    - grape_args are passed to Grape, hamiltonian(qubit_num, mapping) returns the Hops, Hnames and maxA of a block.
+    - Returns, for each gate of qc.op_tab, a dictionary with the pulses 'uks', the final 'error' and the 'file_path'.
+    """
+
+    if grape_args is None:
+        grape_args = {}
+    if 'pulse_library' in grape_args:
+        # several workers would write the same library at once
+        grape_args = dict(grape_args)
+        pulse_library = grape_args.pop('pulse_library')
+        if library is None:
+            library = pulse_library
+        elif library != pulse_library:
+            raise ValueError('library and the pulse_library of grape_args are different files')
+    if processes is None:
+        processes = max(multiprocessing.cpu_count() / threads_per_worker, 1)
+    if not os.path.exists(data_path):
+        os.makedirs(data_path)
+
+    keys, jobs = circuit_jobs(qc, {'total_time': total_time, 'steps': steps, 'data_path': data_path,
+                                   'grape_args': grape_args, 'hamiltonian': hamiltonian, 'threads': threads_per_worker})
+    for key, job in jobs.items():
+        job['file_name'] = file_name + '_' + key[:12]
+
+    results = {}
+    if resume:
+        for key, job in jobs.items():
+            result = find_compiled_block(data_path, job['file_name'])
+            if result is not None:
+                results[key] = result
+
+    pending = [job for key, job in jobs.items() if key not in results]
+    print "%d gates, %d distinct blocks, %d already compiled" % (len(keys), len(jobs), len(results))
+
+    if library is not None:
+        library = PulseLibrary(library)
+        conv_target = 1e-8
+        if 'convergence' in grape_args and 'conv_target' in grape_args['convergence']:
+            conv_target = grape_args['convergence']['conv_target']
+        warm_starts = 0
+        for job in list(pending):
+            H0, Hops, Hnames, maxA = block_hamiltonian(job)
+            hit = library.lookup(H0, Hops, maxA, len(job['mapping']), total_time, job['U'], library_tolerance)
+            if hit is not None and hit['steps'] == steps and hit['error'] <= conv_target:
+                results[job['key']] = {'uks': hit['uks'], 'error': hit['error'], 'file_path': hit['file_path']}
+                pending.remove(job)
+                continue
+            nearest = library.nearest(H0, Hops, maxA, len(job['mapping']), total_time, job['U'])
+            if nearest is not None:
+                initial_guess = resample_pulses(nearest['uks'], steps, nearest['total_time'] / total_time, maxA)
+                job['grape_args'] = dict(grape_args, initial_guess=initial_guess)
+                warm_starts += 1
+        print "%d blocks found in the library, %d warm started" % (len(jobs) - len(pending), warm_starts)
+
+    if len(pending) > 0:
+        for key, result, run_time in run_jobs(compile_block, pending, processes):
+            results[key] = result
+            if library is not None:
+                H0, Hops, Hnames, maxA = block_hamiltonian(jobs[key])
+                library.add(H0, Hops, maxA, len(jobs[key]['mapping']), total_time, jobs[key]['U'],
+                            result['uks'], result['error'], result['file_path'])
+            print "Compiled block %d/%d: error = %1.2e, time = %.1fs, %s" % (
+                len(results), len(jobs), result['error'], run_time, result['file_path'])
+
+    return [results[key] for key in keys]
+
+
+def circuit_min_times(qc, max_time, steps, grape_args=None, hamiltonian=default_hamiltonian, processes=None,
+                      threads_per_worker=1, min_time=None, time_tolerance=None):
+    """
+    - Shortest gate time of each block of qc, after block_merge, with find_min_time on a pool of worker processes.
+      Identical blocks are searched once.
+    - grape_args are passed to Grape, hamiltonian(qubit_num, mapping) returns the Hops, Hnames and maxA of a block.
+    - Returns, for each gate of qc.op_tab, the dictionary of find_min_time, with the shortest 'total_time',
+      None when the block is not reached within max_time, and its pulses 'uks'.
+    """
+
+    if grape_args is None:
+        grape_args = {}
+    if 'pulse_library' in grape_args:
+        raise ValueError('pulse_library is not supported by circuit_min_times, its workers would write it at once')
+    if processes is None:
+        processes = max(multiprocessing.cpu_count() / threads_per_worker, 1)
+
+    keys, jobs = circuit_jobs(qc, {'max_time': max_time, 'steps': steps, 'min_time': min_time,
+                                   'time_tolerance': time_tolerance, 'grape_args': grape_args,
+                                   'hamiltonian': hamiltonian, 'threads': threads_per_worker})
+    print "%d gates, %d distinct blocks" % (len(keys), len(jobs))
+
+    results = {}
+    for key, result, run_time in run_jobs(min_time_block, jobs.values(), processes):
+        results[key] = result
+        print "Block %d/%d: shortest gate time = %s, time = %.1fs" % (
+            len(results), len(jobs), result['total_time'], run_time)
+
+    return [results[key] for key in keys]
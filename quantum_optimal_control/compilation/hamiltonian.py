@@ -5,6 +5,8 @@ import re
 import sys
 import numpy.random
 
+from quantum_optimal_control.helper_functions.kron_operator import KronOperator
+
 def Q_x(qubit_state_num): return np.diag(np.sqrt(np.arange(1,qubit_state_num)),1)+np.diag(np.sqrt(np.arange(1,qubit_state_num)),-1) 
 def Q_y(qubit_state_num): return (0+1j) *(np.diag(np.sqrt(np.arange(1,qubit_state_num)),1)-np.diag(np.sqrt(np.arange(1,qubit_state_num)),-1))
 def Q_z(qubit_state_num): return np.array([[1.0,0.0],[0.0,-1.0]], dtype = np.complex)
@@ -23,7 +25,18 @@ def kron_list(args):
         ret = np.kron(ret, item)
     return ret
 
-def ion_trap_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2):
+def kron_term(op_str, str_dict):
+    # KronOperator of a string of single qubit operators, acting only on the qubits that are not 'i'
+    targets = [ii for ii in range(len(op_str)) if op_str[ii] != 'i']
+    return KronOperator(len(op_str), terms=[(kron_list([str_dict[op_str[ii]] for ii in targets]), targets)])
+
+def build_op(op_str, str_dict, kron):
+    # dense operator of a string of single qubit operators, or its KronOperator if kron is set
+    if kron:
+        return kron_term(op_str, str_dict)
+    return kron_list([str_dict[st] for st in op_str])
+
+def ion_trap_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2, kron=False):
     
     Q_x = np.array([[0.0, 1.0],[1.0,0.0]], dtype = np.complex)
     Q_y = np.array([[0.0, 1.0j],[-1.0j,0.0]], dtype = np.complex)
@@ -34,10 +47,9 @@ def ion_trap_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2):
     for i in range(qubit_num):
         str_x, str_y  = ['i']*qubit_num, ['i']*qubit_num
         str_x[i],str_y[i] = 'x','y'
-        ind_x, ind_y = [str_dict[st] for st in str_x], [str_dict[st] for st in str_y]
 
-        ret_list.append(kron_list(ind_x))
-        ret_list.append(kron_list(ind_y))
+        ret_list.append(build_op(str_x, str_dict, kron))
+        ret_list.append(build_op(str_y, str_dict, kron))
         str_list.append(''.join(str_x))
         str_list.append(''.join(str_y))
         
@@ -47,10 +59,9 @@ def ion_trap_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2):
         for j in range(i, qubit_num):
             str_xx, str_yy  = ['i']*qubit_num, ['i']*qubit_num
             str_xx[i],str_xx[j],str_yy[i], str_yy[j] = 'x','x','y','y'
-            ind_xx, ind_yy = [str_dict[st] for st in str_xx], [str_dict[st] for st in str_yy]
 
-            ret_list.append(kron_list(ind_xx))
-            ret_list.append(kron_list(ind_yy))
+            ret_list.append(build_op(str_xx, str_dict, kron))
+            ret_list.append(build_op(str_yy, str_dict, kron))
             str_list.append(''.join(str_xx))
             str_list.append(''.join(str_yy))
 
@@ -59,7 +70,7 @@ def ion_trap_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2):
 
     return ret_list, str_list, amp_list
 
-def xy_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
+def xy_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping, kron=False):
     # mapping is in the form of a list of tuples
     Q_x = np.array([[0.0, 1.0],[1.0,0.0]], dtype = np.complex)
     Q_y = np.array([[0.0, 1.0j],[-1.0j,0.0]], dtype = np.complex)
@@ -77,12 +88,11 @@ def xy_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
     for i in range(qubit_num):
         str_x, str_y, str_z  = ['i']*qubit_num, ['i']*qubit_num, ['i']*qubit_num
         str_x[i],str_y[i], str_z[i] = 'x','y', 'z'
-        ind_x, ind_y, ind_z = [str_dict[st] for st in str_x], [str_dict[st] for st in str_y],[str_dict[st] for st in str_z]
 
 
-        ret_list.append(kron_list(ind_x))
-        ret_list.append(kron_list(ind_y))
-    #    ret_list.append(kron_list(ind_z))
+        ret_list.append(build_op(str_x, str_dict, kron))
+        ret_list.append(build_op(str_y, str_dict, kron))
+    #    ret_list.append(build_op(str_z, str_dict, kron))
         str_list.append(''.join(str_x))
         str_list.append(''.join(str_y))
     #    str_list.append(''.join(str_z))
@@ -122,9 +132,7 @@ def xy_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
                         con_str_y[index_0] = 'y'
                         con_str_y[index_1] = 'y'
 
-                        op_list_x = [str_dict[ch] for ch in con_str_x]
-                        op_list_y = [str_dict[ch] for ch in con_str_y]
-                        op_xy     = kron_list(op_list_x) + kron_list(op_list_y)
+                        op_xy     = build_op(con_str_x, str_dict, kron) + build_op(con_str_y, str_dict, kron)
 
                         ret_list.append(op_xy)
                         str_list.append(''.join(con_str_x)) # x represents xy
@@ -141,7 +149,7 @@ def xy_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
 
     return ret_list, str_list, amp_list
 
-def jj_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
+def jj_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping, kron=False):
 
     # mapping is in the form of a list of tuples
     Q_x = np.array([[0.0, 1.0],[1.0,0.0]], dtype = np.complex)
@@ -191,10 +199,7 @@ def jj_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
                         con_str_z[index_0] = 'z'
                         con_str_z[index_1] = 'z'
 
-                        op_list_x = [str_dict[ch] for ch in con_str_x]
-                        op_list_y = [str_dict[ch] for ch in con_str_y]
-                        op_list_z = [str_dict[ch] for ch in con_str_z]
-                        op_xyz     = kron_list(op_list_x) + kron_list(op_list_y) + kron_list(op_list_z)
+                        op_xyz     = build_op(con_str_x, str_dict, kron) + build_op(con_str_y, str_dict, kron) + build_op(con_str_z, str_dict, kron)
 
                         ret_list.append(op_xyz)
                         str_list.append(''.join(con_str_x)) # x represents xyz
@@ -211,7 +216,7 @@ def jj_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
 
     return ret_list, str_list, amp_list
 
-def zz_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
+def zz_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping, kron=False):
 
     # mapping is in the form of a list of tuples
     Q_x = np.array([[0.0, 1.0],[1.0,0.0]], dtype = np.complex)
@@ -255,8 +260,7 @@ def zz_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
                         con_str_z[index_0] = 'z'
                         con_str_z[index_1] = 'z'
 
-                        op_list_z = [str_dict[ch] for ch in con_str_z]
-                        op_z     = kron_list(op_list_z)
+                        op_z     = build_op(con_str_z, str_dict, kron)
 
                         ret_list.append(op_z)
                         str_list.append(''.join(con_str_z))
@@ -273,7 +277,7 @@ def zz_hamiltonian_2D(qubit_num, qubit_state_num, amp1, amp2, qubit_mapping):
 
     return ret_list, str_list, amp_list
 
-def sc_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2):
+def sc_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2, kron=False):
     
     Q_x = np.array([[0.0, 1.0],[1.0,0.0]], dtype = np.complex)
     Q_y = np.array([[0.0, 1.0j],[-1.0j,0.0]], dtype = np.complex)
@@ -283,10 +287,9 @@ def sc_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2):
     for i in range(qubit_num):
         str_x, str_y  = ['i']*qubit_num, ['i']*qubit_num
         str_x[i],str_y[i] = 'x','y'
-        ind_x, ind_y = [str_dict[st] for st in str_x], [str_dict[st] for st in str_y]
 
-        ret_list.append(kron_list(ind_x))
-        ret_list.append(kron_list(ind_y))
+        ret_list.append(build_op(str_x, str_dict, kron))
+        ret_list.append(build_op(str_y, str_dict, kron))
         str_list.append(''.join(str_x))
         str_list.append(''.join(str_y))
         
@@ -297,9 +300,8 @@ def sc_Hamiltonian(qubit_num, qubit_state_num, amp1, amp2):
             if i!=j: 
                 str_xx  = ['i']*qubit_num
                 str_xx[i],str_xx[j]= 'x','x'
-                ind_xx = [str_dict[st] for st in str_xx]
 
-                ret_list.append(kron_list(ind_xx))
+                ret_list.append(build_op(str_xx, str_dict, kron))
                 str_list.append(''.join(str_xx))
 
                 amp_list.append(amp2)
@@ -46,6 +46,11 @@ class Analysis:
         if not self.sys_para.use_inter_vecs:
             return None
         
+        inter_vecs = tf.stack(self.tf_inter_vecs).eval()
+        return self.save_inter_vecs(inter_vecs)
+    
+    def save_inter_vecs(self,inter_vecs):
+        # save the propagated states, in the dressed basis if there is one
         state_num = self.sys_para.state_num
         inter_vecs_mag_squared = []
         
@@ -57,8 +62,6 @@ class Analysis:
             
         ii=0
         
-        inter_vecs = tf.stack(self.tf_inter_vecs).eval()
-        
         if self.sys_para.save:
             with H5File(self.sys_para.file_path) as hf:
                 hf.append('inter_vecs_raw_real',np.array(inter_vecs[:,0:state_num,:]))
@@ -50,6 +50,110 @@ class Convergence:
         else:
             self.min_grad = 1e-25
 
+        # multi-start culling: every cull_step iterations, starts whose loss is above (1+cull_margin) times the best are pruned
+        if 'cull_step' in convergence:
+            self.cull_step = convergence['cull_step']
+        else:
+            self.cull_step = None
+
+        if 'cull_margin' in convergence:
+            self.cull_margin = convergence['cull_margin']
+        else:
+            self.cull_margin = 0.5
+
+        # Levenberg-Marquardt damping and conjugate gradient iterations of each step
+        if 'damping' in convergence:
+            self.damping = convergence['damping']
+        else:
+            self.damping = 1e-3
+
+        if 'damping_factor' in convergence:
+            self.damping_factor = convergence['damping_factor']
+        else:
+            self.damping_factor = 3.
+
+        if 'min_damping' in convergence:
+            self.min_damping = convergence['min_damping']
+        else:
+            self.min_damping = 1e-9
+
+        if 'max_damping' in convergence:
+            self.max_damping = convergence['max_damping']
+        else:
+            self.max_damping = 1e9
+
+        if 'cg_iterations' in convergence:
+            self.cg_iterations = convergence['cg_iterations']
+        else:
+            self.cg_iterations = 20
+
+        # learning rate schedule of Adam: 'exponential' decay by learning_rate_decay, 'cosine' decay to min_rate at
+        # max_iterations, 'warm_restarts' of cosine decays over restart_period iterations, growing by restart_mult,
+        # or 'plateau', scaling the rate by plateau_factor when reg_loss did not improve by plateau_threshold
+        # in plateau_step iterations
+        if 'schedule' in convergence:
+            self.schedule = convergence['schedule']
+        else:
+            self.schedule = 'exponential'
+        if self.schedule not in ['exponential', 'cosine', 'warm_restarts', 'plateau']:
+            raise ValueError("Unknown learning rate schedule '%s'" % (self.schedule))
+
+        if 'min_rate' in convergence:
+            self.min_rate = convergence['min_rate']
+        else:
+            self.min_rate = 0.
+
+        if 'restart_period' in convergence:
+            self.restart_period = convergence['restart_period']
+        else:
+            self.restart_period = 500
+
+        if 'restart_mult' in convergence:
+            self.restart_mult = convergence['restart_mult']
+        else:
+            self.restart_mult = 2
+
+        if 'plateau_step' in convergence:
+            self.plateau_step = convergence['plateau_step']
+        else:
+            self.plateau_step = 200
+
+        if 'plateau_factor' in convergence:
+            self.plateau_factor = convergence['plateau_factor']
+        else:
+            self.plateau_factor = 0.5
+
+        if 'plateau_threshold' in convergence:
+            self.plateau_threshold = convergence['plateau_threshold']
+        else:
+            self.plateau_threshold = 1e-3
+
+        # a run stagnates when reg_loss did not improve by plateau_threshold in stagnation_step iterations. It is
+        # restarted from its weights, with the schedule and the Adam moments reset, up to stagnation_restarts
+        # times and then stopped. None never stops
+        if 'stagnation_step' in convergence:
+            self.stagnation_step = convergence['stagnation_step']
+        else:
+            self.stagnation_step = None
+
+        if 'stagnation_restarts' in convergence:
+            self.stagnation_restarts = convergence['stagnation_restarts']
+        else:
+            self.stagnation_restarts = 0
+
+        # a run stops when the trend of its loss does not reach conv_target within trend_margin times max_iterations.
+        # The trend is a line fit to the log of the losses of the last trend_step iterations. None never stops
+        if 'trend_step' in convergence:
+            self.trend_step = convergence['trend_step']
+        else:
+            self.trend_step = None
+        if self.trend_step is not None and self.trend_step < 2:
+            raise ValueError("trend_step needs at least 2 iterations")
+
+        if 'trend_margin' in convergence:
+            self.trend_margin = convergence['trend_margin']
+        else:
+            self.trend_margin = 1.
 
         self.reset_convergence()
         if self.sys_para.show_plots:
@@ -62,7 +166,65 @@ class Convergence:
         self.learning_rate=[]
         self.last_iter = 0
         self.accumulate_rate = 1.00
+        self.restarts = 0
+        self.restart_schedule(0)
+        self.loss_history = []
+    
+    def restart_schedule(self,iteration):
+        # the schedule starts again at iteration, from the full rate
+        self.schedule_start = iteration
+        self.best_loss = None
+        self.best_iteration = iteration
+        self.plateau_iteration = iteration
+        self.plateau_scale = 1.
+    
+    def get_learning_rate(self,iteration):
+        iteration = float(iteration - self.schedule_start)
+        if self.schedule == 'exponential':
+            return float(self.rate) * np.exp(-iteration / self.learning_rate_decay)
+        if self.schedule == 'plateau':
+            return max(float(self.rate) * self.plateau_scale, self.min_rate)
+        
+        if self.schedule == 'cosine':
+            progress = min(iteration / max(self.max_iterations - self.schedule_start, 1), 1.)
+        else:
+            period = float(self.restart_period)
+            while iteration >= period:
+                iteration -= period
+                period *= self.restart_mult
+            progress = iteration / period
+        return self.min_rate + 0.5 * (self.rate - self.min_rate) * (1 + np.cos(np.pi * progress))
+    
+    def update_schedule(self,iteration,loss):
+        # records the loss of an iteration. Returns True when the run stagnated
+        if self.best_loss is None or loss < self.best_loss * (1 - self.plateau_threshold):
+            self.best_loss = loss
+            self.best_iteration = iteration
+            self.plateau_iteration = iteration
+        elif iteration - self.plateau_iteration >= self.plateau_step:
+            self.plateau_scale *= self.plateau_factor
+            self.plateau_iteration = iteration
+        
+        return self.stagnation_step is not None and iteration - self.best_iteration >= self.stagnation_step
         
+    def extrapolate_iterations(self):
+        # iterations still needed to reach conv_target from the trend of the recorded losses, for each problem
+        # in batch mode. Infinite when the losses do not decrease
+        losses = np.log(np.maximum(np.array(self.loss_history[-self.trend_step:]), 1e-300))
+        slope, intercept = np.polyfit(np.arange(self.trend_step), losses, 1)
+        last = intercept + slope * (self.trend_step - 1)
+        decreasing = slope < 0
+        return np.where(decreasing, (np.log(self.conv_target) - last) / np.where(decreasing, slope, -1.), np.inf)
+    
+    def needs_more_time(self,iteration,loss):
+        # records the loss of an iteration. True when the run is not expected to reach conv_target in its budget
+        if self.trend_step is None:
+            return np.zeros(np.shape(loss), dtype=bool)
+        self.loss_history = self.loss_history[-self.trend_step + 1:] + [np.array(loss)]
+        if len(self.loss_history) < self.trend_step:
+            return np.zeros(np.shape(loss), dtype=bool)
+        return iteration + self.extrapolate_iterations() > self.trend_margin * self.max_iterations
+    
     def save_evol(self,anly):
         if self.sys_para.state_transfer == False:
             self.final_state = anly.get_final_state()
@@ -0,0 +1,147 @@
+import numpy as np
+
+
+# optimizer backends of run_session, keyed by the method given to Grape. A backend is called with the run_session
+# once its variables are initialized, runs the optimization and gets the end results.
+# Methods without a backend are passed to scipy.optimize.minimize
+optimizers = {}
+
+
+def register_optimizer(name, optimizer):
+    optimizers[name.upper()] = optimizer
+
+
+def get_optimizer(method):
+    if method.upper() in optimizers:
+        return optimizers[method.upper()]
+    return scipy_optimizer
+
+
+def adam_optimizer(session):
+    session.start_adam_optimizer()
+
+
+def evolve(session):
+    # no optimization, only the propagation of the initial guess
+    session.start_timer()
+    x0 = session.sys_para.ops_weight_base
+    session.l, session.rl, session.grads, session.metric, session.g_squared = session.get_error(x0)
+    session.get_end_results()
+
+
+def scipy_optimizer(session):
+    session.bfgs_optimize(method=session.method)
+
+
+def finite_difference_step(session):
+    # relative step of the central differences, balancing the truncation and rounding errors of the graph precision
+    if session.sys_para.precision == 'float64':
+        return np.finfo(np.float64).eps**(1. / 3)
+    return np.finfo(np.float32).eps**(1. / 3)
+
+
+def newton_cg_optimizer(session):
+    # scipy Newton-CG methods. The Hessian vector products are central differences of the gradient of the graph,
+    # the custom gradients of the propagation can not be differentiated again
+    difference_step = finite_difference_step(session)
+    shape = np.shape(session.sys_para.ops_weight_base)
+
+    def hessp(x, p):
+        p_norm = np.sqrt(np.sum(p * p))
+        if p_norm == 0:
+            return np.zeros_like(p)
+        eps = difference_step * max(1., np.sqrt(np.sum(x * x))) / p_norm
+        grad_plus = session.get_error(np.reshape(x + eps * p, shape))[2]
+        grad_minus = session.get_error(np.reshape(x - eps * p, shape))[2]
+        return np.float64(np.reshape(grad_plus - grad_minus, [-1]) / (2 * eps))
+
+    session.bfgs_optimize(method=session.method, hessp=hessp,
+                          options={'maxiter': session.conv.max_iterations, 'disp': False})
+
+
+def conjugate_gradient(product, b, iterations, tolerance=1e-6):
+    # approximate solution of A x = b for a positive definite A given by its product with a vector
+    x = np.zeros_like(b)
+    r = np.array(b)
+    p = np.array(b)
+    rr = np.sum(r * r)
+    b_norm = np.sqrt(rr)
+    for ii in range(iterations):
+        Ap = product(p)
+        alpha = rr / np.sum(p * Ap)
+        x = x + alpha * p
+        r = r - alpha * Ap
+        rr_new = np.sum(r * r)
+        if np.sqrt(rr_new) <= tolerance * b_norm:
+            break
+        p = r + (rr_new / rr) * p
+        rr = rr_new
+    return x
+
+
+def levenberg_marquardt(session):
+    # damped Gauss-Newton steps on the fidelity residual, with the gradient of all the penalties.
+    # The damping is lowered after a step that reduces reg_loss and raised until a step does
+    tfs = session.tfs
+    conv = session.conv
+    shape = np.shape(session.sys_para.ops_weight_base)
+    weights = np.array(session.sys_para.ops_weight_base, dtype=float)
+    damping = conv.damping
+
+    difference_step = finite_difference_step(session)
+
+    def product(v):
+        # J v as a central difference of the residual, then J^T J v by the gradient of the graph
+        eps = difference_step * max(1., np.sqrt(np.sum(weights * weights))) / np.sqrt(np.sum(v * v))
+        residual_plus = session.session.run(tfs.residual, feed_dict={tfs.ops_weight_value: weights + eps * v})
+        residual_minus = session.session.run(tfs.residual, feed_dict={tfs.ops_weight_value: weights - eps * v})
+        return session.session.run(tfs.gauss_newton_product, feed_dict={
+            tfs.ops_weight_value: weights, tfs.residual_direction: (residual_plus - residual_minus) / (2 * eps)}) \
+            + damping * v
+
+    print "Starting Levenberg-Marquardt Optimization"
+    session.start_timer()
+    session.end = False
+    session.start_writer()
+    try:
+        while True:
+            save_step = session.iterations % conv.update_step == 0
+            evol_step = session.iterations % conv.evol_save_step == 0
+            session.l, session.rl, grads, session.metric, session.g_squared = session.get_error(
+                weights, session.snapshot_fetches(save_step, evol_step))
+
+            if (session.l < conv.conv_target) or (session.g_squared < conv.min_grad) \
+                    or (session.iterations >= conv.max_iterations) or session.check_trend():
+                break
+            if session.show_plots:
+                # the plots evaluate the graph at the variable
+                session.session.run(tfs.assign_weights, feed_dict={tfs.weights_input: weights})
+                session.update_and_save()
+            else:
+                session.save_snapshot(session.snapshot, save_step)
+
+            grads = np.reshape(grads, shape)
+            while damping < conv.max_damping:
+                step = conjugate_gradient(product, -grads, conv.cg_iterations)
+                trial = session.session.run(tfs.reg_loss, feed_dict={tfs.ops_weight_value: weights + step})
+                if trial < session.rl:
+                    weights = weights + step
+                    damping = max(damping / conv.damping_factor, conv.min_damping)
+                    break
+                damping = damping * conv.damping_factor
+            if damping >= conv.max_damping:
+                print "No step lowers the error"
+                break
+    finally:
+        session.stop_writer()
+
+    session.end = True
+    session.session.run(tfs.assign_weights, feed_dict={tfs.weights_input: weights})
+    session.get_end_results()
+
+
+register_optimizer('ADAM', adam_optimizer)
+register_optimizer('EVOLVE', evolve)
+register_optimizer('NEWTON-CG', newton_cg_optimizer)
+register_optimizer('TRUST-NCG', newton_cg_optimizer)
+register_optimizer('LM', levenberg_marquardt)
@@ -26,13 +26,13 @@ def get_reg_loss(tfs):
 
         # Limiting the dwdt of control pulse
         if 'dwdt' in tfs.sys_para.reg_coeffs:
-            zeros_for_training = tf.zeros([tfs.sys_para.ops_len, 2])
+            zeros_for_training = tf.zeros([tfs.sys_para.ops_len, 2],dtype=tfs.dtype)
             new_weights = tf.concat([tfs.ops_weight, zeros_for_training],1)
             new_weights = tf.concat([zeros_for_training, new_weights],1)
             dwdt_reg_alpha_coeff = tfs.sys_para.reg_coeffs['dwdt']
             dwdt_reg_alpha = dwdt_reg_alpha_coeff / float(tfs.sys_para.steps)
             reg_loss = reg_loss + dwdt_reg_alpha * tf.nn.l2_loss(
-                (new_weights[:, 1:] - new_weights[:, :tfs.sys_para.steps + 3]) / tfs.sys_para.dt)
+                (new_weights[:, 1:] - new_weights[:, :tfs.sys_para.steps + 3]) / tfs.tf_dt)
 
         # Limiting the d2wdt2 of control pulse
         if 'd2wdt2' in tfs.sys_para.reg_coeffs:
@@ -42,7 +42,7 @@ def get_reg_loss(tfs):
                                                                               2 * new_weights[:,
                                                                                   1:tfs.sys_para.steps + 3] + new_weights[:,
                                                                                                                :tfs.sys_para.steps + 2]) / (
-                                                                             tfs.sys_para.dt ** 2))
+                                                                             tfs.tf_dt ** 2))
         # bandpass filter on the control    
         if 'bandpass' in tfs.sys_para.reg_coeffs:
             ## currently does not support bandpass reg for CPU (no CPU kernel for FFT)
@@ -52,7 +52,7 @@ def get_reg_loss(tfs):
             bandpass_reg_alpha_coeff = tfs.sys_para.reg_coeffs['bandpass']
             bandpass_reg_alpha = bandpass_reg_alpha_coeff/ float(tfs.sys_para.steps)
             
-            tf_u = tf.cast(tfs.ops_weight,dtype=tf.complex64)
+            tf_u = tf.cast(tfs.ops_weight,dtype=tfs.complex_dtype)
            
             tf_fft = tf.complex_abs(tf.fft(tf_u))
             
@@ -73,7 +73,7 @@ def get_reg_loss(tfs):
             if tfs.sys_para.is_dressed:
                 v_sorted = tf.constant(c_to_r_mat(np.reshape(sort_ev(tfs.sys_para.v_c, tfs.sys_para.dressed_id),
                                                              [len(tfs.sys_para.dressed_id), len(tfs.sys_para.dressed_id)])),
-                                       dtype=tf.float32)
+                                       dtype=tfs.dtype)
 
             for inter_vec in tfs.inter_vecs:
                 if tfs.sys_para.is_dressed and ('forbid_dressed' in tfs.sys_para.reg_coeffs and tfs.sys_para.reg_coeffs['forbid_dressed']):
@@ -97,3 +97,46 @@ def get_reg_loss(tfs):
 
         return reg_loss
                     
+
+
+def get_batch_reg_loss(tfs):
+    
+    # Regulizer of each problem of a batch, weights of the active problems are shaped as (active problems, ops_len, steps)
+    with tf.name_scope('reg_errors'):
+        
+        reg_loss = tfs.loss
+        
+        def l2_loss(t):
+            return 0.5*tf.reduce_sum(tf.square(t),[1,2])
+        
+        # amplitude
+        if 'amplitude' in tfs.sys_para.reg_coeffs:
+            amp_reg_alpha_coeff = tfs.sys_para.reg_coeffs['amplitude']
+            amp_reg_alpha = amp_reg_alpha_coeff / float(tfs.sys_para.steps)
+            reg_loss = reg_loss + amp_reg_alpha * l2_loss(tfs.active_ops_weight)
+        
+        # gaussian envelope
+        if 'envelope' in tfs.sys_para.reg_coeffs:
+            reg_alpha_coeff = tfs.sys_para.reg_coeffs['envelope']
+            reg_alpha = reg_alpha_coeff / float(tfs.sys_para.steps)
+            reg_loss = reg_loss + reg_alpha * l2_loss(
+                tf.multiply(tfs.tf_one_minus_gaussian_envelope, tfs.active_ops_weight))
+
+        # Limiting the dwdt of control pulse
+        if 'dwdt' in tfs.sys_para.reg_coeffs or 'd2wdt2' in tfs.sys_para.reg_coeffs:
+            new_weights = tf.pad(tfs.active_ops_weight,[[0,0],[0,0],[2,2]])
+            
+        if 'dwdt' in tfs.sys_para.reg_coeffs:
+            dwdt_reg_alpha_coeff = tfs.sys_para.reg_coeffs['dwdt']
+            dwdt_reg_alpha = dwdt_reg_alpha_coeff / float(tfs.sys_para.steps)
+            reg_loss = reg_loss + dwdt_reg_alpha * l2_loss(
+                (new_weights[:, :, 1:] - new_weights[:, :, :tfs.sys_para.steps + 3]) / tfs.tf_dt)
+
+        # Limiting the d2wdt2 of control pulse
+        if 'd2wdt2' in tfs.sys_para.reg_coeffs:
+            d2wdt2_reg_alpha_coeff = tfs.sys_para.reg_coeffs['d2wdt2']
+            d2wdt2_reg_alpha = d2wdt2_reg_alpha_coeff / float(tfs.sys_para.steps)
+            reg_loss = reg_loss + d2wdt2_reg_alpha * l2_loss((new_weights[:, :, 2:] - 2 * new_weights[:, :, 1:tfs.sys_para.steps + 3]
+                                                              + new_weights[:, :, :tfs.sys_para.steps + 2]) / (tfs.tf_dt ** 2))
+
+        return reg_loss
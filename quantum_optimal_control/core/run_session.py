@@ -1,6 +1,8 @@
 import numpy as np
 import tensorflow as tf
 from analysis import Analysis
+from snapshot_writer import SnapshotWriter
+from optimizers import get_optimizer
 import os
 import time
 from scipy.optimize import minimize
@@ -8,8 +10,27 @@ from scipy.optimize import minimize
 from quantum_optimal_control.helper_functions.data_management import H5File
 
 
+def session_config(sys_para,use_gpu=True):
+    # tensorflow session configuration for the system parameters
+    if not use_gpu:
+        config = tf.ConfigProto(device_count = {'GPU': 0})
+    else:
+        config = tf.ConfigProto()
+    if sys_para.num_threads is not None:
+        # limit the threads of a session, when several optimizations share a machine
+        config.intra_op_parallelism_threads = sys_para.num_threads
+        config.inter_op_parallelism_threads = sys_para.num_threads
+    if sys_para.propagation == 'scan':
+        # grappler fails on defun gradients that live inside a while loop
+        config.graph_options.rewrite_options.disable_meta_optimizer = True
+    if sys_para.complex_propagation and sys_para.sparse_storage:
+        # grappler zeroes the purely imaginary constant of the sparse values
+        config.graph_options.rewrite_options.disable_meta_optimizer = True
+    return config
+
+
 class run_session:
-    def __init__(self, tfs,graph,conv,sys_para,method,show_plots=True,single_simulation = False,use_gpu =True):
+    def __init__(self, tfs,graph,conv,sys_para,method,show_plots=True,single_simulation = False,use_gpu =True,session=None):
         self.tfs=tfs
         self.graph = graph
         self.conv = conv
@@ -19,54 +40,190 @@ class run_session:
         self.method = method.upper()
         self.show_plots = show_plots
         self.target = False
-        if not use_gpu:
-            config = tf.ConfigProto(device_count = {'GPU': 0})
+        if session is None:
+            with tf.Session(graph=graph, config = session_config(sys_para,use_gpu)) as self.session:
+                self.optimize()
         else:
-            config = None
-        
-        with tf.Session(graph=graph, config = config) as self.session:
-            
-            tf.global_variables_initializer().run()
-
-            print "Initialized"
-            
-            if self.method == 'EVOLVE':
-                self.start_time = time.time()
-                x0 = self.sys_para.ops_weight_base
-                self.l,self.rl,self.grads,self.metric,self.g_squared=self.get_error(x0)
-                self.get_end_results()
+            # a given session is kept open, so it can be reused by later runs on the same graph
+            self.session = session
+            with graph.as_default(), self.session.as_default():
+                self.optimize()
                 
-            else:
-                if self.method != 'ADAM': #Any BFGS scheme
-                    self.bfgs_optimize(method=self.method)
+    def optimize(self):
+        # initialize the variables with the target and initial guess, and run the optimizer
+        self.session.run(self.tfs.init_op, feed_dict=self.tfs.init_feed_dict())
 
-                if self.method =='ADAM':
-                    self.start_adam_optimizer()    
-                
+        print "Initialized"
+        
+        get_optimizer(self.method)(self)
+    
+    def start_timer(self):
+        # start of the optimization, the time of each iteration is recorded
+        self.start_time = time.time()
+        self.iteration_start = self.start_time
+        self.iteration_times = []
+        self.needs_more_time = False
+    
+    def record_iteration_time(self):
+        now = time.time()
+        self.iteration_times.append(now - self.iteration_start)
+        self.iteration_start = now
                   
     def start_adam_optimizer(self):
         # adam optimizer  
-        self.start_time = time.time()
+        self.start_timer()
         self.end = False
-        while True:
-
-            self.g_squared, self.l, self.rl, self.metric = self.session.run(
-                [self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale])
-
-            if (self.l < self.conv.conv_target) or (self.g_squared < self.conv.min_grad) \
-                    or (self.iterations >= self.conv.max_iterations):
-                self.end = True
-
-            self.update_and_save()
+        
+        self.start_writer()
+        try:
+            while True:
                 
-            if self.end:
-                self.get_end_results()
-                break
+                if self.show_plots:
+                    # the plots evaluate the graph again, so the update is run after them
+                    self.g_squared, self.l, self.rl, self.metric = self.session.run(
+                        [self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale])
+                    
+                    if (self.l < self.conv.conv_target) or (self.g_squared < self.conv.min_grad) \
+                            or (self.iterations >= self.conv.max_iterations) or self.check_stagnation() \
+                            or self.check_trend():
+                        self.end = True
+                    
+                    self.update_and_save()
+                    
+                    if self.end:
+                        self.get_end_results()
+                        break
+                    
+                    self.feed_dict = {self.tfs.learning_rate: self.conv.get_learning_rate(self.iterations)}
+                    
+                    _ = self.session.run([self.tfs.optimizer], feed_dict=self.feed_dict)
+                    continue
                 
-            learning_rate = float(self.conv.rate) * np.exp(-float(self.iterations) / self.conv.learning_rate_decay)
-            self.feed_dict = {self.tfs.learning_rate: learning_rate}
-
-            _ = self.session.run([self.tfs.optimizer], feed_dict=self.feed_dict)
+                # fused step: the update of this iteration runs in the same session.run as its losses
+                save_step = self.iterations % self.conv.update_step == 0
+                evol_step = self.iterations % self.conv.evol_save_step == 0
+                snapshot = self.snapshot_fetches(save_step,evol_step)
+                train_step = self.tfs.train_step_snapshot if len(snapshot) > 0 else self.tfs.train_step
+                learning_rate = self.conv.get_learning_rate(self.iterations + 1)
+                self.feed_dict = {self.tfs.learning_rate: learning_rate}
+                _, self.g_squared, self.l, self.rl, self.metric, weights, snapshot = self.session.run(
+                    [train_step, self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss,
+                     self.tfs.unitary_scale, self.tfs.ops_weight_evaluated, snapshot], feed_dict=self.feed_dict)
+                
+                # the schedule is updated with the losses of this iteration, which the plotting loop knows before
+                # its update. The fused update is corrected when they change it
+                restarts = self.conv.restarts
+                if (self.l < self.conv.conv_target) or (self.g_squared < self.conv.min_grad) \
+                        or (self.iterations >= self.conv.max_iterations) or self.check_stagnation() \
+                        or self.check_trend():
+                    self.end = True
+                    # undo the last update, the end results are the evaluated weights
+                    self.session.run(self.tfs.assign_weights, feed_dict={self.tfs.weights_input: weights})
+                elif self.conv.restarts > restarts:
+                    # the update is run again from the evaluated weights, with the reset moments and rate
+                    self.session.run(self.tfs.assign_weights, feed_dict={self.tfs.weights_input: weights})
+                    self.session.run(self.tfs.optimizer, feed_dict={
+                        self.tfs.learning_rate: self.conv.get_learning_rate(self.iterations + 1)})
+                elif self.conv.get_learning_rate(self.iterations + 1) != learning_rate:
+                    # the Adam step is proportional to the rate, and its moments do not depend on it
+                    updated = self.session.run(self.tfs.ops_weight_base)
+                    scale = self.conv.get_learning_rate(self.iterations + 1) / learning_rate
+                    self.session.run(self.tfs.assign_weights,
+                                     feed_dict={self.tfs.weights_input: weights + scale * (updated - weights)})
+                
+                if not self.end:
+                    self.save_snapshot(snapshot,save_step)
+                
+                if self.end:
+                    # the snapshots are written before the end results
+                    self.stop_writer()
+                    self.get_end_results()
+                    break
+        finally:
+            self.stop_writer()
+    
+    def check_stagnation(self):
+        # records the loss of the iteration for the learning rate schedule. A stagnated run is restarted, or ended
+        # once it used all its restarts
+        if not self.conv.update_schedule(self.iterations,self.rl):
+            return False
+        if self.conv.restarts < self.conv.stagnation_restarts:
+            self.conv.restarts += 1
+            self.conv.restart_schedule(self.iterations)
+            self.session.run(self.tfs.reset_optimizer)
+            print "Optimization stagnated at iteration %d, restart %d" % (self.iterations, self.conv.restarts)
+            return False
+        print "Optimization stagnated at iteration %d" % (self.iterations)
+        return True
+    
+    def check_trend(self,loss=None):
+        # a run which the trend of its loss does not bring to the conv_target within max_iterations is ended
+        if loss is None:
+            loss = self.l
+        if self.conv.needs_more_time(self.iterations,loss):
+            print "Optimization needs more time: conv_target is not reached within max_iterations"
+            self.needs_more_time = True
+        return self.needs_more_time
+    
+    def start_writer(self):
+        # without plots, the saved snapshots are fetched with the losses and written on a background thread
+        self.writer = None
+        if self.sys_para.save and not self.show_plots:
+            self.writer = SnapshotWriter(self.write_snapshot)
+    
+    def stop_writer(self):
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
+    
+    def snapshot_fetches(self,save_step,evol_step):
+        # tensors to fetch with the losses of an iteration, for the writer and the display
+        if self.show_plots:
+            return {}
+        if self.writer is None or not (save_step or evol_step):
+            if self.sys_para.expmv == 'krylov' and save_step:
+                return {'krylov_error': self.tfs.krylov_error}
+            return {}
+        fetches = {'ops_weight': self.tfs.ops_weight}
+        if self.sys_para.expmv == 'krylov':
+            fetches['krylov_error'] = self.tfs.krylov_error
+        if evol_step:
+            if not self.sys_para.state_transfer:
+                fetches['final_state'] = self.tfs.final_state
+            if self.sys_para.use_inter_vecs and self.tfs.inter_vecs_stacked is not None:
+                fetches['inter_vecs'] = self.tfs.inter_vecs_stacked
+        return fetches
+    
+    def save_snapshot(self,snapshot,save_step):
+        # pass a fetched snapshot to the writer, with the losses of the same iteration, and display them
+        self.elapsed = time.time() - self.start_time
+        if 'krylov_error' in snapshot:
+            self.krylov_error = snapshot['krylov_error']
+        if self.writer is not None and 'ops_weight' in snapshot:
+            snapshot.update({'error': self.l, 'reg_error': self.rl, 'unitary_scale': self.metric,
+                             'iteration': self.iterations, 'run_time': self.elapsed, 'save_data': save_step})
+            self.writer.put(snapshot)
+        if save_step:
+            self.display()
+        self.record_iteration_time()
+        self.iterations += 1
+    
+    def write_snapshot(self,snapshot):
+        # write a snapshot to the data file, called on the writer thread
+        if snapshot['save_data'] or 'final_state' in snapshot or 'inter_vecs' in snapshot:
+            with H5File(self.sys_para.file_path) as hf:
+                hf.append('error', np.array(snapshot['error']))
+                hf.append('reg_error', np.array(snapshot['reg_error']))
+                hf.append('uks', np.reshape(self.sys_para.ops_max_amp,[-1,1])*snapshot['ops_weight'])
+                hf.append('iteration', np.array(snapshot['iteration']))
+                hf.append('run_time', np.array(snapshot['run_time']))
+                hf.append('unitary_scale', np.array(snapshot['unitary_scale']))
+                if 'krylov_error' in snapshot:
+                    hf.append('krylov_error', np.array(snapshot['krylov_error']))
+                if 'final_state' in snapshot:
+                    hf.append('final_state', np.array(snapshot['final_state']))
+        if 'inter_vecs' in snapshot:
+            Analysis(self.sys_para, None, None, None, None).save_inter_vecs(snapshot['inter_vecs'])
 
                 
                 
@@ -89,6 +246,7 @@ class run_session:
                         self.save_data()
                     self.conv.save_evol(self.anly)
 
+            self.record_iteration_time()
             self.iterations += 1
     
     def get_end_results(self):
@@ -108,6 +266,18 @@ class run_session:
             self.Uf = self.anly.get_final_state()
         else:
             self.Uf = []
+        
+        self.error_trajectory = None
+        if self.tfs.error_trajectory is not None:
+            self.error_trajectory = self.session.run(self.tfs.error_trajectory)
+        
+        if len(self.iteration_times) > 0:
+            print "Mean iteration time: %.4fs" % (np.mean(self.iteration_times))
+        if self.sys_para.save:
+            with H5File(self.sys_para.file_path) as hf:
+                hf.add('needs_more_time',data=self.needs_more_time)
+                if len(self.iteration_times) > 0:
+                    hf.add('iteration_time',data=np.array(self.iteration_times))
     
     def Get_uks(self): 
         # to get the pulse amplitudes
@@ -116,19 +286,24 @@ class run_session:
             uks[ii] = self.sys_para.ops_max_amp[ii]*uks[ii]
         return uks    
 
-    def get_error(self,uks):
-        #get error and gradient for scipy bfgs:
-        self.session.run(self.tfs.ops_weight_base.assign(uks))
-
-        g,l,rl,metric,g_squared = self.session.run([self.tfs.grad_pack, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale, self.tfs.grad_squared])
+    def get_error(self,uks,snapshot=None):
+        #get error and gradient for scipy bfgs, the weights are fed so a single run evaluates them
+        if snapshot is None:
+            snapshot = {}
+        g,l,rl,metric,g_squared,snapshot = self.session.run(
+            [self.tfs.grad_pack, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale, self.tfs.grad_squared, snapshot],
+            feed_dict={self.tfs.ops_weight_value: uks})
+        self.snapshot = snapshot
         
         final_g = np.transpose(np.reshape(g,(len(self.sys_para.ops_c)*self.sys_para.steps)))
 
         return l,rl,final_g,metric, g_squared
     
     def save_data(self):
+        if self.sys_para.expmv == 'krylov':
+            self.krylov_error = self.session.run(self.tfs.krylov_error)
+        self.elapsed = time.time() - self.start_time
         if self.sys_para.save:
-            self.elapsed = time.time() - self.start_time
             with H5File(self.sys_para.file_path) as hf:
                 hf.append('error', np.array(self.l))
                 hf.append('reg_error', np.array(self.rl))
@@ -136,6 +311,8 @@ class run_session:
                 hf.append('iteration', np.array(self.iterations))
                 hf.append('run_time', np.array(self.elapsed))
                 hf.append('unitary_scale', np.array(self.metric))
+                if self.sys_para.expmv == 'krylov':
+                    hf.append('krylov_error', np.array(self.krylov_error))
     
     
     def display(self):
@@ -146,11 +323,20 @@ class run_session:
         else:
             print 'Error = :%1.2e; Runtime: %.1fs; Iterations = %d, grads =  %10.3e, unitary_metric = %.5f' % (
             self.l, self.elapsed, self.iterations, self.g_squared, self.metric)
+            if self.sys_para.expmv == 'krylov':
+                print 'Krylov error estimate = %1.2e' % (self.krylov_error)
     
     
     def minimize_opt_fun(self,x):
         # minimization function called by scipy in each iteration
-        self.l,self.rl,self.grads,self.metric,self.g_squared=self.get_error(np.reshape(x,(len(self.sys_para.ops_c),len(x)/len(self.sys_para.ops_c))))
+        if self.last_point is not None and np.array_equal(x,self.last_point):
+            # scipy evaluates the same point again, e.g. at the end of a line search
+            return self.last_result
+        
+        uks = np.reshape(x,(len(self.sys_para.ops_c),len(x)/len(self.sys_para.ops_c)))
+        save_step = self.iterations % self.conv.update_step == 0
+        evol_step = self.iterations % self.conv.evol_save_step == 0
+        self.l,self.rl,self.grads,self.metric,self.g_squared=self.get_error(uks,self.snapshot_fetches(save_step,evol_step))
         
         if self.l <self.conv.conv_target :
             self.conv_time = time.time()-self.start_time
@@ -158,16 +344,41 @@ class run_session:
             self.end = True
             print 'Target fidelity reached'
             self.grads= 0*self.grads # set zero grads to terminate the scipy optimization
+        elif self.needs_more_time:
+            # set by the trend of the accepted iterates
+            self.end = True
+            self.grads= 0*self.grads
         
-        self.update_and_save()
+        if self.show_plots:
+            # the plots evaluate the graph at the variable
+            self.session.run(self.tfs.assign_weights, feed_dict={self.tfs.weights_input: uks})
+            self.update_and_save()
+        elif not self.end:
+            self.save_snapshot(self.snapshot,save_step)
         
         if self.method == 'L-BFGS-B':
-            return np.float64(self.rl),np.float64(np.transpose(self.grads))
+            result = np.float64(self.rl),np.float64(np.transpose(self.grads))
         else:
-            return self.rl,np.reshape(np.transpose(self.grads),[len(np.transpose(self.grads))])
+            result = self.rl,np.reshape(np.transpose(self.grads),[len(np.transpose(self.grads))])
+        self.last_point = np.array(x)
+        self.last_result = result
+        return result
 
     
-    def bfgs_optimize(self, method='L-BFGS-B',jac = True, options=None):
+    def minimize_callback(self,x):
+        # called by scipy on each accepted iterate. The trend only follows these losses, the trial points of the
+        # line searches do not decrease monotonically. The iterations count the function evaluations, so the
+        # iterations still needed are a lower bound
+        if self.end:
+            return
+        if self.last_point is not None and np.array_equal(x,self.last_point):
+            loss = self.l
+        else:
+            uks = np.reshape(x,(len(self.sys_para.ops_c),len(x)/len(self.sys_para.ops_c)))
+            loss = self.session.run(self.tfs.loss, feed_dict={self.tfs.ops_weight_value: uks})
+        self.check_trend(loss)
+    
+    def bfgs_optimize(self, method='L-BFGS-B',jac = True, options=None, hessp=None):
         # scipy optimizer
         self.conv.reset_convergence()
         self.first=True
@@ -175,25 +386,191 @@ class run_session:
         self.conv_iter=0
         self.end=False
         print "Starting " + self.method + " Optimization"
-        self.start_time = time.time()
+        self.start_timer()
+        self.last_point = None
         
         x0 = self.sys_para.ops_weight_base
-        options={'maxfun' : self.conv.max_iterations,'gtol': self.conv.min_grad, 'disp':False,'maxls': 40}
+        if options is None:
+            options={'maxfun' : self.conv.max_iterations,'gtol': self.conv.min_grad, 'disp':False,'maxls': 40}
         
-        res = minimize(self.minimize_opt_fun,x0,method=method,jac=jac,options=options)
+        self.start_writer()
+        try:
+            if hessp is None:
+                res = minimize(self.minimize_opt_fun,x0,method=method,jac=jac,options=options,
+                               callback=self.minimize_callback)
+            else:
+                res = minimize(self.minimize_opt_fun,x0,method=method,jac=jac,hessp=hessp,options=options,
+                               callback=self.minimize_callback)
+        finally:
+            self.stop_writer()
 
+        # the end results are evaluated at the solution
         uks=np.reshape(res['x'],(len(self.sys_para.ops_c),len(res['x'])/len(self.sys_para.ops_c)))
+        self.session.run(self.tfs.assign_weights, feed_dict={self.tfs.weights_input: uks})
 
         print self.method + ' optimization done'
         
-        g, l,rl = self.session.run([self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss])
+        self.g_squared, self.l, self.rl, self.metric = self.session.run(
+            [self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale])
             
         if self.sys_para.show_plots == False:
             print res.message
-            print("Error = %1.2e" %l)
+            print("Error = %1.2e" %self.l)
             print ("Total time is " + str(time.time() - self.start_time))
             
         self.get_end_results()          
 
     
         
+
+
+class batch_run_session:
+    # Adam optimization of a batch of problems sharing one graph. Each problem is stopped on its own
+    # convergence criteria, its weights are then frozen and it is no longer propagated.
+    # With multi_start, the problems are starts of the same optimization: the optimization ends as soon as
+    # one of them converges, and the starts trailing the best one are pruned every cull_step iterations.
+    def __init__(self, tfs,graph,conv,sys_para,method,use_gpu =True,session=None,multi_start=False):
+        self.tfs=tfs
+        self.graph = graph
+        self.conv = conv
+        self.sys_para = sys_para
+        self.iterations = 0
+        self.method = method.upper()
+        self.multi_start = multi_start
+        if self.method != 'ADAM':
+            raise ValueError('batch optimization only supports the ADAM method')
+        
+        if session is None:
+            with tf.Session(graph=graph, config = session_config(sys_para,use_gpu)) as self.session:
+                self.optimize()
+        else:
+            self.session = session
+            with graph.as_default(), self.session.as_default():
+                self.optimize()
+                
+    def optimize(self):
+        self.session.run(self.tfs.init_op, feed_dict=self.tfs.init_feed_dict())
+
+        print "Initialized"
+        
+        batch_size = self.sys_para.batch_size
+        self.start_time = time.time()
+        self.active = np.ones(batch_size,dtype=bool)
+        self.frozen_weights = np.array(self.sys_para.ops_weight_base)
+        self.converged_iterations = -np.ones(batch_size,dtype=int)
+        self.needs_more_time = np.zeros(batch_size,dtype=bool)
+        self.l = np.zeros(batch_size)
+        self.rl = np.zeros(batch_size)
+        self.metric = np.zeros(batch_size)
+        self.g_squared = np.zeros(batch_size)
+        while True:
+            
+            # fused step: the update of the active problems runs in the same session.run as their losses, only the
+            # active problems are propagated
+            active_indices = np.nonzero(self.active)[0]
+            learning_rate = self.conv.get_learning_rate(self.iterations + 1)
+            self.feed_dict = {self.tfs.learning_rate: learning_rate, self.tfs.active_indices: active_indices,
+                              self.tfs.frozen_weights: self.frozen_weights}
+            _, g_squared, l, rl, metric, self.ops_weight, weights = self.session.run(
+                [self.tfs.train_step, self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale,
+                 self.tfs.ops_weight, self.tfs.ops_weight_evaluated], feed_dict=self.feed_dict)
+            self.g_squared[active_indices] = g_squared
+            self.l[active_indices] = l
+            self.rl[active_indices] = rl
+            self.metric[active_indices] = metric
+            
+            # stop the problems that reached their target
+            converged = self.active & (self.l < self.conv.conv_target)
+            stopped = converged | (self.active & (self.g_squared < self.conv.min_grad))
+            self.converged_iterations[stopped] = self.iterations
+            # stop the problems which the trend of their loss does not bring to the target within max_iterations
+            hopeless = self.active & ~converged & self.conv.needs_more_time(self.iterations,self.l)
+            self.needs_more_time = self.needs_more_time | hopeless
+            stopped = stopped | hopeless
+            if self.multi_start and self.conv.cull_step is not None and self.iterations > 0 \
+                    and self.iterations % self.conv.cull_step == 0:
+                best = np.min(self.l[self.active])
+                stopped = stopped | (self.active & (self.l > (1+self.conv.cull_margin)*best))
+            self.frozen_weights[stopped] = weights[stopped]
+            self.active = self.active & ~stopped
+
+            end = (not np.any(self.active)) or (self.iterations >= self.conv.max_iterations)
+            if self.multi_start and np.any(converged):
+                end = True
+            restarts = self.conv.restarts
+            if not end:
+                # the schedule follows the best active problem
+                end = self.check_stagnation(np.min(self.rl[self.active]))
+            
+            # the fused update is corrected when the losses of this iteration change it
+            if end:
+                # undo the last update, the end results are the evaluated weights
+                self.session.run(self.tfs.assign_weights, feed_dict={self.tfs.weights_input: weights})
+            elif self.conv.restarts > restarts:
+                # the update is run again from the evaluated weights, with the reset moments and rate
+                self.session.run(self.tfs.assign_weights, feed_dict={self.tfs.weights_input: weights})
+                self.session.run(self.tfs.optimizer, feed_dict={
+                    self.tfs.learning_rate: self.conv.get_learning_rate(self.iterations + 1),
+                    self.tfs.active_indices: np.nonzero(self.active)[0], self.tfs.frozen_weights: self.frozen_weights})
+            elif np.any(stopped) or self.conv.get_learning_rate(self.iterations + 1) != learning_rate:
+                # the Adam step is proportional to the rate, and the problems stopped now keep their evaluated weights
+                updated = self.session.run(self.tfs.ops_weight_base)
+                scale = self.conv.get_learning_rate(self.iterations + 1) / learning_rate
+                weights = np.where(np.reshape(self.active,[-1,1,1]), weights + scale * (updated - weights), weights)
+                self.session.run(self.tfs.assign_weights, feed_dict={self.tfs.weights_input: weights})
+            
+            if end or self.iterations % self.conv.update_step == 0:
+                self.save_data()
+                self.display()
+                
+            if end:
+                self.get_end_results()
+                break
+                
+            self.iterations += 1
+            
+    def check_stagnation(self,loss):
+        if not self.conv.update_schedule(self.iterations,loss):
+            return False
+        if self.conv.restarts < self.conv.stagnation_restarts:
+            self.conv.restarts += 1
+            self.conv.restart_schedule(self.iterations)
+            self.session.run(self.tfs.reset_optimizer)
+            print "Optimization stagnated at iteration %d, restart %d" % (self.iterations, self.conv.restarts)
+            return False
+        print "Optimization stagnated at iteration %d" % (self.iterations)
+        return True
+    
+    def get_end_results(self):
+        # optimized pulses and final unitaries of all the problems
+        ops_weight, final_state = self.session.run([self.tfs.ops_weight, self.tfs.final_state])
+        
+        state_num = self.sys_para.state_num
+        self.uks = []
+        self.Uf = []
+        for ii in range(self.sys_para.batch_size):
+            self.uks.append(np.reshape(self.sys_para.ops_max_amp,[-1,1])*ops_weight[ii])
+            self.Uf.append(final_state[ii,:state_num,:state_num]+1j*final_state[ii,state_num:2*state_num,:state_num])
+            
+        if self.sys_para.save:
+            with H5File(self.sys_para.file_path) as hf:
+                hf.append('final_state',np.array(final_state))
+                hf.add('converged_iterations',data=self.converged_iterations)
+                hf.add('needs_more_time',data=self.needs_more_time)
+    
+    def save_data(self):
+        self.elapsed = time.time() - self.start_time
+        if self.sys_para.save:
+            # the weights evaluated by the last fused step, the variable already holds the next ones
+            with H5File(self.sys_para.file_path) as hf:
+                hf.append('error', np.array(self.l))
+                hf.append('reg_error', np.array(self.rl))
+                hf.append('uks', np.reshape(self.sys_para.ops_max_amp,[1,-1,1])*self.ops_weight)
+                hf.append('iteration', np.array(self.iterations))
+                hf.append('run_time', np.array(self.elapsed))
+                hf.append('unitary_scale', np.array(self.metric))
+                hf.append('active', np.array(self.active))
+                
+    def display(self):
+        print 'Errors: max = %1.2e, min = %1.2e; Runtime: %.1fs; Iterations = %d, active problems = %d/%d' % (
+            np.max(self.l), np.min(self.l), self.elapsed, self.iterations, np.sum(self.active), self.sys_para.batch_size)
@@ -0,0 +1,43 @@
+import sys
+import threading
+import Queue
+
+
+class SnapshotWriter:
+    # writes snapshots of an optimization on a background thread, so saving does not stall the optimizer.
+    # The queue is bounded: when the writer falls behind, put blocks until a snapshot is written.
+    # An error of the writer is raised again in the optimizer thread, on the next put or on close.
+
+    def __init__(self, write, maxsize=4):
+        self.write = write
+        self.queue = Queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            snapshot = self.queue.get()
+            if snapshot is None:
+                break
+            if self.error is None:
+                try:
+                    self.write(snapshot)
+                except:
+                    self.error = sys.exc_info()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def put(self, snapshot):
+        self.raise_error()
+        self.queue.put(snapshot)
+
+    def close(self):
+        # wait until all the snapshots are written
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
@@ -2,16 +2,35 @@ import numpy as np
 from quantum_optimal_control.helper_functions.grape_functions import c_to_r_mat
 from quantum_optimal_control.helper_functions.grape_functions import c_to_r_vec
 from quantum_optimal_control.helper_functions.grape_functions import get_state_index
+from quantum_optimal_control.helper_functions.kron_operator import KronOperator
 import scipy.linalg as la
+import scipy.sparse as sp
 from scipy.special import factorial
+import hashlib
 
 from quantum_optimal_control.helper_functions.data_management import H5File
 
+
+def array_key(array):
+    # hashable summary of the content of an array
+    array = np.ascontiguousarray(array)
+    return (array.shape, str(array.dtype), hashlib.sha1(array.tostring()).hexdigest())
+
+
 class SystemParameters:
 
     def __init__(self,H0,Hops,Hnames,U,U0,total_time,steps,states_concerned_list,dressed_info,maxA, draw,initial_guess, show_plots,Unitary_error,state_transfer,no_scaling,reg_coeffs, save, file_path, Taylor_terms,use_gpu,use_inter_vecs,sparse_H,
-                sparse_U,sparse_K, circuit_name):
+                sparse_U,sparse_K, circuit_name, propagation='unrolled', checkpoint_step=None,
+                complex_propagation=False, precision='float32', expmv='taylor',
+                sparse_storage=False, max_total_time=None, batch_size=None, num_threads=None,
+                error_trajectory=False, method='ADAM'):
         # Input variable
+        self.propagation = propagation
+        self.checkpoint_step = checkpoint_step
+        self.complex_propagation = complex_propagation
+        self.precision = precision
+        self.expmv = expmv
+        self.sparse_storage = sparse_storage
         self.sparse_U = sparse_U
         self.sparse_H = sparse_H
         self.sparse_K = sparse_K
@@ -30,19 +49,84 @@ class SystemParameters:
         self.Hnames = Hnames
         self.Hnames_original = Hnames #because we might rearrange them later if we have different timescales 
         self.total_time = total_time
+        self.max_total_time = max_total_time
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.error_trajectory = error_trajectory
+        self.method = method.upper()
         self.steps = steps
         self.show_plots = show_plots
         self.Unitary_error= Unitary_error
         self.circuit_name = circuit_name
-
+        
+        self.kron_operators = False
+        for op in [H0] + list(Hops):
+            if isinstance(op,KronOperator):
+                self.kron_operators = True
+                register = op
+        if self.kron_operators:
+            # dense operators are turned into a single term acting on the whole register
+            if not isinstance(H0,KronOperator):
+                self.H0_c = KronOperator.from_dense(H0,register.subsystem_num,register.levels)
+            self.ops_c = []
+            for op in Hops:
+                if not isinstance(op,KronOperator):
+                    op = KronOperator.from_dense(op,register.subsystem_num,register.levels)
+                self.ops_c.append(op)
+
+        if self.propagation not in ['unrolled','scan','prefix','adjoint']:
+            raise ValueError('Unknown propagation mode: %s' % (self.propagation))
+        if self.propagation in ['prefix','adjoint'] and self.state_transfer:
+            raise ValueError('%s propagation is only supported for unitary optimization' % (self.propagation))
+        if self.propagation == 'adjoint' and reg_coeffs is not None:
+            # intermediate vectors are not part of the adjoint gradient
+            for reg in ['forbidden_coeff_list','speed_up']:
+                if reg in reg_coeffs:
+                    raise ValueError('%s regularization is not supported with adjoint propagation' % (reg))
+        if self.checkpoint_step is not None:
+            if self.propagation != 'unrolled' or self.state_transfer:
+                raise ValueError('checkpoint_step is only supported with unrolled propagation for unitary optimization')
+            if self.checkpoint_step < 1:
+                raise ValueError('checkpoint_step has to be a positive number of steps')
+        if self.precision not in ['float32','float64']:
+            raise ValueError('Unknown precision: %s' % (self.precision))
+        if self.expmv not in ['taylor','krylov']:
+            raise ValueError('Unknown expmv method: %s' % (self.expmv))
+        if self.expmv == 'krylov' and not self.state_transfer:
+            raise ValueError('krylov expmv is only supported for state transfer')
+        if self.sparse_storage and not (self.propagation == 'unrolled' and self.checkpoint_step is None
+                                        or self.propagation == 'scan' and self.state_transfer):
+            raise ValueError('sparse_storage is only supported with unrolled propagation, or scan propagation for state transfer')
+        if self.complex_propagation and (self.propagation == 'adjoint' or self.checkpoint_step is not None):
+            raise ValueError('complex_propagation is not supported with adjoint propagation or checkpointing')
+        if self.max_total_time is not None and self.max_total_time < self.total_time:
+            raise ValueError('max_total_time has to be at least total_time')
+        if self.batch_size is not None:
+            if self.state_transfer or self.propagation != 'scan':
+                raise ValueError('batch optimization is only supported with scan propagation for unitary optimization')
+            if self.sparse_storage or self.kron_operators:
+                raise ValueError('batch optimization is not supported with sparse_storage or Kronecker structured operators')
+            if len(U) != self.batch_size:
+                raise ValueError('batch optimization needs one target unitary per problem')
+            if reg_coeffs is not None:
+                # only the penalties on the pulses are evaluated per problem
+                for reg in ['forbidden_coeff_list','speed_up','bandpass']:
+                    if reg in reg_coeffs:
+                        raise ValueError('%s regularization is not supported with batch optimization' % (reg))
+        if self.kron_operators:
+            if not self.complex_propagation:
+                raise ValueError('Kronecker structured operators require complex_propagation')
+            if self.sparse_storage or not (self.propagation == 'unrolled' and self.checkpoint_step is None
+                                           or self.propagation == 'scan' and self.state_transfer):
+                raise ValueError('Kronecker structured operators are only supported with unrolled propagation, or scan propagation for state transfer')
 
         if initial_guess is not None:
             # transform initial_guess to its corresponding base value
+            # with batch optimization the guess is either shared or given for each problem
             self.u0 = initial_guess
-            self.u0_base = np.zeros_like(self.u0)
-            for ii in range (len(self.u0_base)):
-                self.u0_base[ii]= self.u0[ii]/self.ops_max_amp[ii]
-                if max(self.u0_base[ii])> 1.0:
+            self.u0_base = np.array(self.u0,dtype=float)/np.reshape(self.ops_max_amp,[-1,1])
+            for ii in range (len(self.ops_max_amp)):
+                if np.max(self.u0_base[...,ii,:])> 1.0:
                     raise ValueError('Initial guess has strength > max_amp for op %d' % (ii) )
             self.u0_base = np.arcsin(self.u0_base) #because we take the sin of weights later
                 
@@ -56,10 +140,13 @@ class SystemParameters:
         self.is_dressed = False
         self.U0_c = U0
         self.initial_unitary = c_to_r_mat(U0) #CtoRMat is converting complex matrices to their equivalent real (double the size) matrices
-        if self.state_transfer == False:
+        if self.batch_size is not None:
+            self.target_unitary = np.array([c_to_r_mat(target) for target in U])
+        elif self.state_transfer == False:
             self.target_unitary = c_to_r_mat(U)
         else:
             self.target_vectors=[]
+            self.target_vectors_c = U
 
             for target_vector_c in U:
                 self.target_vector = c_to_r_vec(target_vector_c)
@@ -130,8 +217,12 @@ class SystemParameters:
         U_f = self.U0_c
         for ii in range (len(self.ops_c)):
             H = H + self.ops_max_amp[ii]*self.ops_c[ii]
+        if self.kron_operators:
+            max_H = self.reference_dt*H.max_abs()
+        else:
+            max_H = np.max(np.abs(-(0+1j) * self.reference_dt*H))
         if d == 0:
-            self.scaling = max(int(2*np.log2(np.max(np.abs(-(0+1j) * self.dt*H)))),0) 
+            self.scaling = max(int(2*np.log2(max_H)),0) 
 
         else:
             self.scaling += d
@@ -140,12 +231,12 @@ class SystemParameters:
             self.scaling =0
         while True:
 
-            if len(self.H0_c) < 10:
+            if len(self.H0_c) < 10 and not self.kron_operators:
                 for ii in range (self.steps):
-                    U_f = np.dot(U_f,self.approx_expm((0-1j)*self.dt*H, exp_t, self.scaling))
+                    U_f = np.dot(U_f,self.approx_expm((0-1j)*self.reference_dt*H, exp_t, self.scaling))
                 Metric = np.abs(np.trace(np.dot(np.conjugate(np.transpose(U_f)), U_f)))/(self.state_num)
             else:
-                max_term = np.max(np.abs(-(0+1j) * self.dt*H))
+                max_term = max_H
                 
                 Metric = 1 + self.steps *np.abs((self.approx_exp(max_term, exp_t, self.scaling) - np.exp(max_term))/np.exp(max_term))
 
@@ -157,12 +248,60 @@ class SystemParameters:
                 break
         
         return exp_t
+    
+    def krylov_error(self,A,psi,m):
+        # a posteriori error estimate of the Arnoldi approximation of exp(A) psi in a Krylov subspace of dimension m
+        beta = np.linalg.norm(psi)
+        if beta == 0:
+            return 0.
+        V = [psi/beta]
+        H_m = np.zeros((m+1,m),dtype=complex)
+        for jj in range(m):
+            w = A.dot(V[jj])
+            for ii in range(jj+1):
+                H_m[ii,jj] = np.vdot(V[ii],w)
+                w = w - H_m[ii,jj]*V[ii]
+            H_m[jj+1,jj] = np.linalg.norm(w)
+            if H_m[jj+1,jj] == 0:
+                return 0.
+            V.append(w/H_m[jj+1,jj])
+        
+        return beta*np.abs(H_m[m,m-1])*np.abs(la.expm(H_m[0:m,:])[m-1,0])
+    
+    def Choose_krylov_dim(self):
+        # smallest Krylov subspace dimension for which the error estimate accumulated over all the steps is below Unitary_error.
+        # The estimate is done at the maximum amplitudes for the initial and target vectors, and for the uniform
+        # superposition which stands for the spread out states met during the evolution.
+        H=self.H0_c
+        for ii in range (len(self.ops_c)):
+            H = H + self.ops_max_amp[ii]*self.ops_c[ii]
+        A = -1j*self.reference_dt*H
+        vectors = [np.array(psi,dtype=complex) for psi in self.initial_vectors_c + list(self.target_vectors_c)]
+        vectors.append(np.ones(self.state_num,dtype=complex)/np.sqrt(self.state_num))
+        if not self.complex_propagation:
+            # the real representation only spans its Krylov subspace over the reals
+            A = c_to_r_mat(A)
+            vectors = [c_to_r_vec(psi) for psi in vectors]
+        
+        max_dim = min(len(A),30)
+        for m in range(2,max_dim):
+            error = max([self.krylov_error(A,psi,m) for psi in vectors])
+            if self.steps*error < self.Unitary_error:
+                return m
+        
+        return max_dim
 
 
 
         
     def init_system(self):
         self.dt = float(self.total_time)/self.steps        
+        # the operators are built for the time step of max_total_time and scaled down to dt in the graph,
+        # so the exponentiation settings hold for every total_time up to max_total_time
+        if self.max_total_time is None:
+            self.reference_dt = self.dt
+        else:
+            self.reference_dt = float(self.max_total_time)/self.steps
         self.state_num= len(self.H0_c)
         
         
@@ -194,17 +333,18 @@ class SystemParameters:
 
     def init_operators(self):
         # Create operator matrix in numpy array
-
-        self.ops=[]
-        for op_c in self.ops_c:
-            op = c_to_r_mat(-1j*self.dt*op_c)
-            self.ops.append(op)
         
-        self.ops_len = len(self.ops)
-
-        self.H0 = c_to_r_mat(-1j*self.dt*self.H0_c)
-        self.identity_c = np.identity(self.state_num)
-        self.identity = c_to_r_mat(self.identity_c)
+        self.ops_len = len(self.ops_c)
+        
+        if not self.kron_operators and not self.sparse_storage:
+            self.ops=[]
+            for op_c in self.ops_c:
+                op = c_to_r_mat(-1j*self.reference_dt*op_c)
+                self.ops.append(op)
+
+            self.H0 = c_to_r_mat(-1j*self.reference_dt*self.H0_c)
+            self.identity_c = np.identity(self.state_num)
+            self.identity = c_to_r_mat(self.identity_c)
         
         if self.Taylor_terms is None:
             self.exps =[]
@@ -238,6 +378,21 @@ class SystemParameters:
         
         print "Using "+ str(self.exp_terms) + " Taylor terms and "+ str(self.scaling)+" Scaling & Squaring terms"
         
+        if self.expmv == 'krylov':
+            self.krylov_dim = self.Choose_krylov_dim()
+            if self.save:
+                with H5File(self.file_path) as hf:
+                    hf.add('krylov_dim',data=self.krylov_dim)
+            print "Using a Krylov subspace of dimension "+ str(self.krylov_dim)
+        
+        if self.kron_operators:
+            self.init_kron_operators()
+            return
+        
+        if self.sparse_storage:
+            self.init_sparse_operators()
+            return
+        
         i_array = np.eye(2*self.state_num)
         op_matrix_I=i_array.tolist()
         
@@ -251,6 +406,48 @@ class SystemParameters:
         
         self.matrix_list = np.array(self.matrix_list)
         
+        if self.complex_propagation:
+            # the propagation uses the complex N x N matrices instead of their 2N x 2N real equivalents
+            self.matrix_list = [-1j*self.reference_dt*self.H0_c] + [-1j*self.reference_dt*op_c for op_c in self.ops_c] + [self.identity_c]
+            self.matrix_list = np.array(self.matrix_list,dtype=complex)
+        
+    def init_sparse_operators(self):
+        # the matrices are only built as scipy sparse matrices: H_all holds the values of every matrix but the identity
+        # on their union sparsity pattern, in row major order
+        matrices = []
+        for op_c in [self.H0_c] + list(self.ops_c):
+            matrix = -1j*self.reference_dt*sp.csr_matrix(op_c,dtype=complex)
+            if not self.complex_propagation:
+                matrix = sp.bmat([[matrix.real,-matrix.imag],[matrix.imag,matrix.real]],format='csr')
+            matrices.append(matrix)
+        
+        pattern = sum([abs(matrix) for matrix in matrices]).tocsr()
+        pattern.eliminate_zeros()
+        pattern.sort_indices()
+        pattern = pattern.tocoo()
+        self.sparse_indices = np.transpose([pattern.row,pattern.col]).astype(np.int64)
+        self.sparse_values = np.array([np.asarray(matrix[pattern.row,pattern.col]).ravel() for matrix in matrices])
+        if not self.complex_propagation:
+            self.sparse_values = self.sparse_values.real
+        print "Using sparse storage with "+ str(len(self.sparse_indices)) + " nonzeros out of "+ str(pattern.shape[0]*pattern.shape[1])
+        
+    def init_kron_operators(self):
+        # the local matrices of all the terms are packed in a single vector,
+        # kron_terms holds (operator index, target subsystems, offset in the vector, local dimension) of every term
+        self.kron_terms = []
+        values = []
+        offset = 0
+        for kk, op in enumerate([self.H0_c] + list(self.ops_c)):
+            for matrix, targets in op.terms:
+                self.kron_terms.append((kk,targets,offset,len(matrix)))
+                values.append(np.reshape(-1j*self.reference_dt*matrix,[-1]))
+                offset = offset + matrix.size
+        self.kron_values = np.concatenate(values)
+        self.subsystem_num = self.H0_c.subsystem_num
+        self.subsystem_levels = self.H0_c.levels
+        
+        print "Using "+ str(len(self.kron_terms)) + " Kronecker structured terms"
+        
     def init_one_minus_gaussian_envelope(self):
         # Generating the Gaussian envelope that pulses should obey
         one_minus_gauss = []
@@ -267,12 +464,56 @@ class SystemParameters:
         self.one_minus_gauss = np.array(one_minus_gauss)
 
 
+    def graph_key(self):
+        # everything the tensorflow graph is built from, except the target, the initial guess and dt
+        # which are fed when the graph variables are initialized. The cached session is configured with num_threads,
+        # and the method can add its own operations
+        if self.kron_operators:
+            operators = (array_key(self.kron_values),repr([term[1:] for term in self.kron_terms]))
+        elif self.sparse_storage:
+            operators = (array_key(self.sparse_values),array_key(self.sparse_indices))
+        else:
+            operators = array_key(self.matrix_list)
+
+        reg_coeffs = []
+        if self.reg_coeffs is not None:
+            for k in sorted(self.reg_coeffs.keys()):
+                reg_coeffs.append((k,array_key(np.array(self.reg_coeffs[k]))))
+
+        dressed = None
+        if self.is_dressed:
+            dressed = (array_key(self.v_c),repr(self.dressed_id))
+
+        krylov_dim = None
+        if self.expmv == 'krylov':
+            krylov_dim = self.krylov_dim
+
+        # the bandpass frequencies are turned into indices with total_time when the graph is built
+        total_time = None
+        if self.reg_coeffs is not None and 'bandpass' in self.reg_coeffs:
+            total_time = self.total_time
+
+        return (self.batch_size, self.state_num, self.ops_len, self.steps, self.exp_terms, self.scaling, krylov_dim,
+                self.state_transfer, self.propagation, self.checkpoint_step, self.complex_propagation,
+                self.precision, self.expmv, self.sparse_storage, self.kron_operators, self.use_inter_vecs,
+                self.error_trajectory, self.use_gpu, self.num_threads, self.sparse_H, self.sparse_U, self.sparse_K,
+                self.reference_dt, total_time, self.method,
+                tuple(reg_coeffs), dressed, array_key(self.ops_max_amp), operators,
+                array_key(self.initial_vectors), array_key(self.initial_unitary))
+
     def gaussian(self,x, mu = 0. , sig = 1. ):
         return np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
 
     def init_guess(self):
         # initail guess for control field
-        if self.u0 != []:
+        if self.batch_size is not None:
+            # weights get a leading batch dimension
+            shape = [self.batch_size,self.ops_len,self.steps]
+            if self.u0 != []:
+                self.ops_weight_base = np.array(np.broadcast_to(np.reshape(self.u0_base,[-1,self.ops_len,self.steps]),shape))
+            else:
+                self.ops_weight_base = np.random.normal(0, 1./np.sqrt(self.steps), shape)
+        elif self.u0 != []:
             
             self.ops_weight_base = np.reshape(self.u0_base, [self.ops_len,self.steps])
         else:
@@ -4,7 +4,7 @@ import numpy as np
 import tensorflow as tf
 import math
 from quantum_optimal_control.helper_functions.grape_functions import c_to_r_mat, sort_ev
-from regularization_functions import get_reg_loss
+from regularization_functions import get_reg_loss, get_batch_reg_loss
 from tensorflow.python.framework import function
 from tensorflow.python.framework import ops
 
@@ -14,31 +14,137 @@ class TensorflowState:
         
         self.sys_para = sys_para
         
+        # floating point precision of the graph
+        if self.sys_para.precision == 'float64':
+            self.dtype = tf.float64
+            self.complex_dtype = tf.complex128
+        else:
+            self.dtype = tf.float32
+            self.complex_dtype = tf.complex64
+        
+        # propagation runs either on the 2N real representation or natively on complex N x N matrices
+        if self.sys_para.complex_propagation:
+            self.matrix_dtype = self.complex_dtype
+            self.propagation_dim = self.sys_para.state_num
+        else:
+            self.matrix_dtype = self.dtype
+            self.propagation_dim = 2*self.sys_para.state_num
+        
     
     def init_defined_functions(self):
         # define propagation functions used for evolution
         input_num = len(self.sys_para.Hnames) +1
         taylor_terms = self.sys_para.exp_terms 
         scaling = self.sys_para.scaling
+        dtype = self.dtype
+        matrix_dtype = self.matrix_dtype
         
+        def weighted(uk,H):
+            # control amplitudes are real, the matrices might be complex
+            return tf.cast(uk,matrix_dtype)*H
         
-        def get_matexp(uks,H_all):
-            # matrix exponential
-            I = H_all[input_num]
-            matexp = I
+        def overlap(grad,M):
+            # derivative of the loss along M, for complex matrices grad holds dL/dRe + i*dL/dIm
+            return tf.real(tf.reduce_sum(tf.multiply(tf.conj(grad),M)))
+        
+        # with sparse storage H_all only holds the values of the matrices on their union sparsity pattern,
+        # shaped as (input_num, number of nonzeros), and the identity is not part of it
+        sparse_storage = self.sys_para.sparse_storage
+        if sparse_storage:
+            sparse_indices = self.sys_para.sparse_indices
+        
+        # with Kronecker structured operators H_all holds the packed local matrices of all the terms,
+        # every term is applied by contracting its local matrix with the target subsystems
+        kron_operators = self.sys_para.kron_operators
+        if kron_operators:
+            kron_terms = self.sys_para.kron_terms
+            subsystem_num = self.sys_para.subsystem_num
+            levels = self.sys_para.subsystem_levels
+        
+        dim = self.propagation_dim
+        
+        def get_local(H_all,term):
+            # local matrix of a Kronecker structured term
+            kk, targets, offset, local_dim = term
+            return tf.reshape(H_all[offset:offset+local_dim*local_dim],[local_dim,local_dim])
+        
+        def apply_local(M,targets,X):
+            # product of the local matrix M acting on the target subsystems with X, shaped as (dim, number of columns)
+            k = len(targets)
+            Y = tf.tensordot(tf.reshape(M,[levels]*(2*k)),tf.reshape(X,[levels]*subsystem_num+[-1]),
+                             axes=[range(k,2*k),list(targets)])
+            # the contracted axes come first in Y, move them back in place
+            axes = list(targets) + [a for a in range(subsystem_num+1) if a not in targets]
+            return tf.reshape(tf.transpose(Y,list(np.argsort(axes))),tf.shape(X))
+        
+        def get_weighted_sum(uks,H_all):
+            # sum of the matrices weighted by the control amplitudes, a SparseTensor with sparse storage
+            # and a list of (local matrix, targets) with Kronecker structured operators
+            if sparse_storage:
+                values = tf.reduce_sum(tf.expand_dims(tf.cast(uks,matrix_dtype),1)*H_all,0)
+                return tf.SparseTensor(sparse_indices,values,[dim,dim])
+            
+            if kron_operators:
+                # terms on the same subsystems are merged so they are applied with a single contraction
+                local_terms = {}
+                for term in kron_terms:
+                    local_terms.setdefault(term[1],[]).append(weighted(uks[term[0]],get_local(H_all,term)))
+                return [(tf.add_n(local_terms[targets]),targets) for targets in sorted(local_terms)]
+            
             uks_Hk_list = []
             for ii in range(input_num):
-                uks_Hk_list.append((uks[ii]/(2.**scaling))*H_all[ii])
+                uks_Hk_list.append(weighted(uks[ii],H_all[ii]))
                 
-            H = tf.add_n(uks_Hk_list)
-            H_n = H
+            return tf.add_n(uks_Hk_list)
+        
+        def apply(H,X,b_is_sparse=False):
+            # product of the weighted sum H with the dense X
+            if sparse_storage:
+                return tf.sparse_tensor_dense_matmul(H,X)
+            if kron_operators:
+                return tf.add_n([apply_local(M,targets,X) for M, targets in H])
+            return tf.matmul(H,X,a_is_sparse=self.sys_para.sparse_H,b_is_sparse=b_is_sparse)
+        
+        def get_coeff_grad(grad,M,H_all,b_is_sparse=False):
+            # derivatives of the loss along H_k M for all the controls, the drift gets no gradient
+            if kron_operators:
+                coeff_grad = [[] for ii in range(input_num)]
+                for term in kron_terms:
+                    if term[0] > 0:
+                        coeff_grad[term[0]].append(overlap(grad,apply_local(get_local(H_all,term),term[1],M)))
+                return tf.stack([tf.add_n(coeff) if coeff else tf.constant(0,dtype=dtype) for coeff in coeff_grad])
+            
+            if sparse_storage:
+                # sum(conj(grad) * H_k M) is the sum over the nonzeros (a,b) of H_k[a,b] * (conj(grad) M^T)[a,b]
+                grad_M = tf.reduce_sum(tf.multiply(tf.gather(tf.conj(grad),sparse_indices[:,0]),
+                                                   tf.gather(M,sparse_indices[:,1])),1)
+                coeff_grad = tf.real(tf.matmul(H_all[1:input_num],tf.expand_dims(grad_M,1)))[:,0]
+                return tf.concat([tf.zeros([1],dtype=dtype),coeff_grad],0)
+            
+            coeff_grad = []
+            coeff_grad.append(tf.constant(0,dtype=dtype))
+            for ii in range(1,input_num):
+                coeff_grad.append(overlap(grad,
+                       tf.matmul(H_all[ii],M,a_is_sparse=self.sys_para.sparse_H,b_is_sparse=b_is_sparse)))
+            return tf.stack(coeff_grad)
+        
+        def get_matexp(uks,H_all):
+            # matrix exponential
+            H = get_weighted_sum(uks/(2.**scaling),H_all)
+            if sparse_storage or kron_operators:
+                I = tf.eye(dim,dtype=matrix_dtype)
+                H_n = apply(H,I)
+            else:
+                I = H_all[input_num]
+                H_n = H
+            matexp = I
             factorial = 1.
 
             for ii in range(1,taylor_terms+1):      
                 factorial = factorial * ii
                 matexp = matexp + H_n/factorial
                 if not ii == (taylor_terms):
-                    H_n = tf.matmul(H,H_n,a_is_sparse=self.sys_para.sparse_H,b_is_sparse=self.sys_para.sparse_U)
+                    H_n = apply(H,H_n,b_is_sparse=self.sys_para.sparse_U)
 
             for ii in range(scaling):
                 matexp = tf.matmul(matexp,matexp,a_is_sparse=self.sys_para.sparse_U,b_is_sparse=self.sys_para.sparse_U)
@@ -46,95 +152,267 @@ class TensorflowState:
             return matexp
             
         
-        @function.Defun(tf.float32,tf.float32,tf.float32)
+        @function.Defun(dtype,matrix_dtype,matrix_dtype)
         def matexp_op_grad(uks,H_all, grad):  
             # gradient of matrix exponential
-            coeff_grad = []
-
-            coeff_grad.append(tf.constant(0,dtype=tf.float32))
-            
             
             ### get output of the function
             matexp = get_matexp(uks,H_all)          
             ###
             
-            for ii in range(1,input_num):
-                coeff_grad.append(tf.reduce_sum(tf.multiply(grad,
-                       tf.matmul(H_all[ii],matexp,a_is_sparse=self.sys_para.sparse_H,b_is_sparse=self.sys_para.sparse_U))))
+            coeff_grad = get_coeff_grad(grad,matexp,H_all,b_is_sparse=self.sys_para.sparse_U)
 
-            return [tf.stack(coeff_grad), tf.zeros(tf.shape(H_all),dtype=tf.float32)]                                         
+            return [coeff_grad, tf.zeros(tf.shape(H_all),dtype=matrix_dtype)]                                         
 
         global matexp_op
         
         
-        @function.Defun(tf.float32,tf.float32, grad_func=matexp_op_grad)                       
+        @function.Defun(dtype,matrix_dtype, grad_func=matexp_op_grad)                       
         def matexp_op(uks,H_all):
             # matrix exponential defun operator
             matexp = get_matexp(uks,H_all)
 
             return matexp 
         
-        def get_matvecexp(uks,H_all,psi):
-            # matrix vector exponential
+        def get_matexp_batch(weights,H_all):
+            # matrix exponential of all the time steps at once
+            # weights is shaped as (input_num, steps), output is shaped as (steps, dim, dim)
+            dim = tf.shape(H_all)[1]
             I = H_all[input_num]
-            matvecexp = psi
             
-            uks_Hk_list = []
+            H = tf.matmul(tf.cast(tf.transpose(weights)/(2.**scaling),matrix_dtype),tf.reshape(H_all[0:input_num],[input_num,-1]))
+            H = tf.reshape(H,[-1,dim,dim])
+            matexp = I + H
+            H_n = H
+            factorial = 1.
+
+            for ii in range(2,taylor_terms+1):      
+                factorial = factorial * ii
+                H_n = tf.matmul(H,H_n)
+                matexp = matexp + H_n/factorial
+
+            for ii in range(scaling):
+                matexp = tf.matmul(matexp,matexp)
+
+            return matexp
+        
+        @function.Defun(dtype,matrix_dtype,matrix_dtype)
+        def matexp_batch_op_grad(weights,H_all,grad):  
+            # gradient of the batched matrix exponential, same approximation as matexp_op_grad
+            dim = tf.shape(H_all)[1]
+            
+            ### get output of the function
+            matexp = get_matexp_batch(weights,H_all)
+            ###
             
+            # sum(grad * H_k matexp) is evaluated as sum(H_k * grad matexp^T) for all the steps at once
+            grad_matexp = tf.reshape(tf.matmul(tf.conj(grad),matexp,transpose_b=True),[-1,dim*dim])
+            coeff_grad = tf.real(tf.matmul(tf.reshape(H_all[1:input_num],[input_num-1,-1]),grad_matexp,transpose_b=True))
+            coeff_grad = tf.concat([tf.zeros_like(coeff_grad[0:1,:]),coeff_grad],0)
+
+            return [coeff_grad, tf.zeros(tf.shape(H_all),dtype=matrix_dtype)]
+        
+        global matexp_batch_op
+        
+        @function.Defun(dtype,matrix_dtype, grad_func=matexp_batch_op_grad)                       
+        def matexp_batch_op(weights,H_all):
+            # batched matrix exponential defun operator
+            matexp = get_matexp_batch(weights,H_all)
+
+            return matexp 
+        
+        def get_generator(uks,H_all):
+            # generator of the step propagator, without scaling
+            uks_Hk_list = []
             for ii in range(input_num):
                 uks_Hk_list.append(uks[ii]*H_all[ii])
-
-            H = tf.add_n(uks_Hk_list)    
+                
+            return tf.add_n(uks_Hk_list)
+        
+        def get_matexp_frechet(H,I,E):
+            # matrix exponential of the generator H and its exact derivative in the direction E.
+            # (X, dX) pairs are carried through the same Taylor series and scaling and squaring as get_matexp,
+            # so the derivative is exact for the approximated exponential
+            H = H/(2.**scaling)
+            E = E/(2.**scaling)
+            matexp = I + H
+            d_matexp = E
+            H_n = H
+            d_H_n = E
+            factorial = 1.
+            
+            for ii in range(2,taylor_terms+1):
+                factorial = factorial * ii
+                d_H_n = tf.matmul(E,H_n) + tf.matmul(H,d_H_n)
+                H_n = tf.matmul(H,H_n)
+                matexp = matexp + H_n/factorial
+                d_matexp = d_matexp + d_H_n/factorial
+                
+            for ii in range(scaling):
+                d_matexp = tf.matmul(d_matexp,matexp) + tf.matmul(matexp,d_matexp)
+                matexp = tf.matmul(matexp,matexp)
+                
+            return matexp, d_matexp
+        
+        def get_propagate(weights,H_all,U0):
+            # propagate U0 through all the time steps, only the current state is kept
+            steps = tf.shape(weights)[1]
+            
+            def body(ii,U):
+                return ii+1, tf.matmul(get_matexp(weights[:,ii],H_all),U)
+            
+            _, U = tf.while_loop(lambda ii,U: ii < steps, body, [tf.constant(0),U0])
+            
+            return U
+        
+        @function.Defun(dtype,dtype,dtype,dtype)
+        def propagate_op_grad(weights,H_all,U0,grad):
+            # adjoint gradient of the propagation: the co-state is propagated backward from the final state while
+            # the step propagators are recomputed and inverted, so memory does not grow with the number of steps
+            steps = tf.shape(weights)[1]
+            I = H_all[input_num]
+            H_ops = tf.reshape(H_all[1:input_num],[input_num-1,-1])
+            
+            ### get output of the function
+            U_final = get_propagate(weights,H_all,U0)
+            ###
+            
+            coeff_grads = tf.TensorArray(dtype,size=steps)
+            
+            def body(ii,U,costate,coeff_grads):
+                matexp = get_matexp(weights[:,ii],H_all)
+                U_previous = tf.matmul(matexp,U,transpose_a=True) # propagators are orthogonal
+                
+                # derivative of the loss with respect to the step propagator,
+                # contracted with the exact derivative of the exponential through <G, L(H,H_k)> = <L(H^T,G), H_k>
+                grad_matexp = tf.matmul(costate,U_previous,transpose_b=True)
+                _, d_matexp = get_matexp_frechet(tf.transpose(get_generator(weights[:,ii],H_all)),I,grad_matexp)
+                coeff_grads = coeff_grads.write(ii,tf.matmul(H_ops,tf.reshape(d_matexp,[-1,1]))[:,0])
+                
+                return ii-1, U_previous, tf.matmul(matexp,costate,transpose_a=True), coeff_grads
+            
+            _, _, costate, coeff_grads = tf.while_loop(lambda ii,U,costate,coeff_grads: ii >= 0, body,
+                                                       [steps-1,U_final,grad,coeff_grads])
+            
+            coeff_grad = tf.transpose(coeff_grads.stack())
+            coeff_grad = tf.concat([tf.zeros_like(coeff_grad[0:1,:]),coeff_grad],0)
+            
+            return [coeff_grad, tf.zeros(tf.shape(H_all),dtype=dtype), costate]
+        
+        global propagate_op
+        
+        @function.Defun(dtype,dtype,dtype, grad_func=propagate_op_grad)
+        def propagate_op(weights,H_all,U0):
+            # propagation defun operator, returns the final state only
+            U_final = get_propagate(weights,H_all,U0)
+            
+            return U_final
+        
+        global inter_vecs_op
+        
+        @function.Defun(dtype,dtype,dtype,dtype)
+        def inter_vecs_op(weights,H_all,U0,psi):
+            # intermediate vectors of the unitary evolution, shaped as (steps, 2*state_num, number of vectors)
+            steps = tf.shape(weights)[1]
+            inter_vecs = tf.TensorArray(dtype,size=steps)
             
+            def body(ii,U,inter_vecs):
+                U = tf.matmul(get_matexp(weights[:,ii],H_all),U)
+                return ii+1, U, inter_vecs.write(ii,tf.matmul(U,psi))
+            
+            _, _, inter_vecs = tf.while_loop(lambda ii,U,inter_vecs: ii < steps, body,
+                                             [tf.constant(0),U0,inter_vecs])
+            
+            return inter_vecs.stack()
+        
+        def get_expmv_taylor(H,psi):
+            # exp(H) psi with a truncated Taylor series
+            expmv = psi
             psi_n = psi
             factorial = 1.
 
             for ii in range(1,taylor_terms):      
                 factorial = factorial * ii
-                psi_n = tf.matmul(H,psi_n,a_is_sparse=self.sys_para.sparse_H,b_is_sparse=self.sys_para.sparse_K)
-                matvecexp = matvecexp + psi_n/factorial
+                psi_n = apply(H,psi_n,b_is_sparse=self.sys_para.sparse_K)
+                expmv = expmv + psi_n/factorial
 
-            return matvecexp
+            return expmv
+        
+        def norm(v):
+            # 2-norm of every column of v
+            return tf.sqrt(tf.real(tf.reduce_sum(tf.multiply(tf.conj(v),v),0)))
+        
+        def get_expmv_krylov(H,psi):
+            # exp(H) psi projected on the Krylov subspace spanned by psi, H psi, ..., H^(m-1) psi,
+            # for all the columns of psi at once. The Arnoldi iteration gives the orthonormal basis V and
+            # the small Hessenberg matrix H_m, then exp(H) psi ~ beta V exp(H_m) e_1.
+            # Also returns the error estimate beta h_(m+1,m) |e_m^T exp(H_m) e_1| of every column.
+            m = self.sys_para.krylov_dim
+            beta = norm(psi)
+            # a zero column, e.g. a zero gradient vector, stays zero instead of turning into nan
+            V = [psi/tf.cast(tf.maximum(beta,1e-30),matrix_dtype)]
+            h = {}
+            
+            for jj in range(m):
+                w = apply(H,V[jj],b_is_sparse=self.sys_para.sparse_K)
+                for ii in range(jj+1):
+                    h[ii,jj] = tf.reduce_sum(tf.multiply(tf.conj(V[ii]),w),0)
+                    w = w - h[ii,jj]*V[ii]
+                h_next = norm(w)
+                h[jj+1,jj] = tf.cast(h_next,matrix_dtype)
+                if jj < m-1:
+                    # the guard only matters on breakdown, when the subspace is already invariant
+                    V.append(w/tf.cast(tf.maximum(h_next,1e-30),matrix_dtype))
+            
+            # H_m is shaped as (number of vectors, m, m)
+            zero = tf.zeros_like(h[0,0])
+            H_m = tf.stack([tf.stack([h.get((ii,jj),zero) for jj in range(m)],1) for ii in range(m)],1)
+            exp_H_m = tf.linalg.expm(H_m)
+            
+            coeffs = tf.expand_dims(tf.cast(beta,matrix_dtype),1)*exp_H_m[:,:,0]
+            expmv = tf.add_n([V[jj]*coeffs[:,jj] for jj in range(m)])
+            error = beta*tf.abs(h[m,m-1])*tf.abs(exp_H_m[:,m-1,0])
+            
+            return expmv, error
+        
+        def get_expmv(H,psi):
+            if self.sys_para.expmv == 'krylov':
+                return get_expmv_krylov(H,psi)[0]
+            return get_expmv_taylor(H,psi)
+        
+        def get_matvecexp(uks,H_all,psi):
+            # matrix vector exponential
+            H = get_weighted_sum(uks,H_all)
             
+            return get_expmv(H,psi)
         
-        @function.Defun(tf.float32,tf.float32,tf.float32,tf.float32)
+        def get_krylov_error(uks,H_all,psi):
+            # error estimate of the Krylov matrix vector exponential for every column of psi
+            H = get_weighted_sum(uks,H_all)
+            
+            return get_expmv_krylov(H,psi)[1]
+        
+        self.get_krylov_error = get_krylov_error
+            
+        
+        @function.Defun(dtype,matrix_dtype,matrix_dtype,matrix_dtype)
         def matvecexp_op_grad(uks,H_all,psi, grad):  
             # graident of matrix vector exponential
-            coeff_grad = []
-
-            coeff_grad.append(tf.constant(0,dtype=tf.float32))
             
             ### get output of the function
             matvecexp = get_matvecexp(uks,H_all,psi)
             #####
             
+            coeff_grad = get_coeff_grad(grad,matvecexp,H_all,b_is_sparse=self.sys_para.sparse_K)
             
-            for ii in range(1,input_num):
-                coeff_grad.append(tf.reduce_sum(tf.multiply(grad,
-                       tf.matmul(H_all[ii],matvecexp,a_is_sparse=self.sys_para.sparse_H,b_is_sparse=self.sys_para.sparse_K))))
-                
-             
-            
-            I = H_all[input_num]
-            vec_grad = grad
-            uks_Hk_list = []
-            for ii in range(input_num):
-                uks_Hk_list.append((-uks[ii])*H_all[ii])
-                
-            H = tf.add_n(uks_Hk_list)
-            vec_grad_n = grad
-            factorial = 1.
+            H = get_weighted_sum(-uks,H_all)
+            vec_grad = get_expmv(H,grad)
 
-            for ii in range(1,taylor_terms):      
-                factorial = factorial * ii
-                vec_grad_n = tf.matmul(H,vec_grad_n,a_is_sparse=self.sys_para.sparse_H,b_is_sparse=self.sys_para.sparse_K)
-                vec_grad = vec_grad + vec_grad_n/factorial
-
-            return [tf.stack(coeff_grad), tf.zeros(tf.shape(H_all),dtype=tf.float32),vec_grad]                                         
+            return [coeff_grad, tf.zeros(tf.shape(H_all),dtype=matrix_dtype),vec_grad]                                         
         
         global matvecexp_op
         
-        @function.Defun(tf.float32,tf.float32,tf.float32, grad_func=matvecexp_op_grad)                       
+        @function.Defun(dtype,matrix_dtype,matrix_dtype, grad_func=matvecexp_op_grad)                       
         def matvecexp_op(uks,H_all,psi):
             # matrix vector exponential defun operator
             matvecexp = get_matvecexp(uks,H_all,psi)
@@ -144,41 +422,89 @@ class TensorflowState:
  
 
     def init_variables(self):
-        self.tf_one_minus_gaussian_envelope = tf.constant(self.sys_para.one_minus_gauss,dtype=tf.float32, name = 'Gaussian')
+        self.tf_one_minus_gaussian_envelope = tf.constant(self.sys_para.one_minus_gauss,dtype=self.dtype, name = 'Gaussian')
         
         
     def init_tf_vectors(self):
 
         self.tf_initial_vectors=[]
         for initial_vector in self.sys_para.initial_vectors:
-            tf_initial_vector = tf.constant(initial_vector,dtype=tf.float32)
+            tf_initial_vector = tf.constant(initial_vector,dtype=self.dtype)
             self.tf_initial_vectors.append(tf_initial_vector)
         self.packed_initial_vectors = tf.transpose(tf.stack(self.tf_initial_vectors))
+        
+        # vectors used in the propagation
+        if self.sys_para.complex_propagation:
+            state_num = self.sys_para.state_num
+            self.propagation_vectors = tf.complex(self.packed_initial_vectors[0:state_num,:],
+                                                  self.packed_initial_vectors[state_num:2*state_num,:])
+        else:
+            self.propagation_vectors = self.packed_initial_vectors
     
     def init_tf_propagators(self):
         #tf initial and target propagator
+        # the target is a variable initialized from a fed value, so a cached graph can be reused for new targets
         if self.sys_para.state_transfer:
-            self.target_vecs = tf.transpose(tf.constant(np.array(self.sys_para.target_vectors),dtype=tf.float32))
+            self.target_input = tf.placeholder(self.dtype,shape=np.shape(self.sys_para.target_vectors),name='target')
+            self.target_vecs = tf.transpose(tf.Variable(self.target_input,trainable=False,name='target_vecs'))
         else:
-            self.tf_initial_unitary = tf.constant(self.sys_para.initial_unitary,dtype=tf.float32, name = 'U0')
-            self.tf_target_state = tf.constant(self.sys_para.target_unitary,dtype=tf.float32)
+            if self.sys_para.complex_propagation:
+                self.tf_initial_unitary = tf.constant(self.sys_para.U0_c,dtype=self.matrix_dtype, name = 'U0')
+            else:
+                self.tf_initial_unitary = tf.constant(self.sys_para.initial_unitary,dtype=self.dtype, name = 'U0')
+            self.target_input = tf.placeholder(self.dtype,shape=np.shape(self.sys_para.target_unitary),name='target')
+            self.tf_target_state = tf.Variable(self.target_input,trainable=False,name='target_state')
             self.target_vecs = tf.matmul(self.tf_target_state,self.packed_initial_vectors)
         print "Propagators initialized."
+        
+    def to_real_mat(self,M):
+        # complex to real isomorphism for propagated matrices, the loss and outputs use the real representation
+        if not self.sys_para.complex_propagation:
+            return M
+        return tf.concat([tf.concat([tf.real(M),-tf.imag(M)],-1),tf.concat([tf.imag(M),tf.real(M)],-1)],-2)
+    
+    def to_real_vecs(self,V):
+        # complex to real isomorphism for propagated vectors shaped as (..., state_num, number of vectors)
+        if not self.sys_para.complex_propagation:
+            return V
+        return tf.concat([tf.real(V),tf.imag(V)],-2)
     
     def init_tf_ops_weight(self):
        
         #tf weights of operators
             
-        self.H0_weight = tf.Variable(tf.ones([self.sys_para.steps]), trainable=False) #Just a vector of ones needed for the kernel
+        self.H0_weight = tf.Variable(tf.ones([self.sys_para.steps],dtype=self.dtype), trainable=False) #Just a vector of ones needed for the kernel
         self.weights_unpacked=[self.H0_weight] #will collect all weights here
-        self.ops_weight_base = tf.Variable(tf.constant(self.sys_para.ops_weight_base, dtype = tf.float32), dtype=tf.float32,name ="weights_base")
+        self.initial_weights = tf.placeholder(self.dtype,shape=np.shape(self.sys_para.ops_weight_base),name="initial_weights")
+        self.ops_weight_base = tf.Variable(self.initial_weights, dtype=self.dtype,name ="weights_base")
 
-        self.ops_weight = tf.sin(self.ops_weight_base,name="weights")
+        if self.sys_para.batch_size is None:
+            # the weights can be fed instead of read from the variable, the scipy optimizers evaluate their points
+            # this way without assigning the variable
+            self.ops_weight_value = tf.placeholder_with_default(self.ops_weight_base,
+                                                                shape=np.shape(self.sys_para.ops_weight_base),
+                                                                name="weights_value")
+        else:
+            self.ops_weight_value = self.ops_weight_base
+        self.ops_weight = tf.sin(self.ops_weight_value,name="weights")
+        if self.sys_para.batch_size is None:
+            propagated_weight = self.ops_weight
+        else:
+            # only the active problems of a batch are propagated, packed weights are shaped as (active problems, ops_len+1, steps)
+            self.active_indices = tf.placeholder_with_default(tf.range(self.sys_para.batch_size),shape=[None],
+                                                              name="active_indices")
+            self.active_weight_base = tf.gather(self.ops_weight_base,self.active_indices)
+            self.active_ops_weight = tf.sin(self.active_weight_base)
+            propagated_weight = self.active_ops_weight
+            self.weights_unpacked[0] = tf.ones_like(propagated_weight[:,0,:])
         for ii in range (self.sys_para.ops_len):
-            self.weights_unpacked.append(self.sys_para.ops_max_amp[ii]*self.ops_weight[ii,:])
+            self.weights_unpacked.append(self.sys_para.ops_max_amp[ii]*propagated_weight[...,ii,:])
 
         #print len(self.sys_para.ops_max_amp)
-        self.H_weights = tf.stack(self.weights_unpacked,name="packed_weights")
+        # the operators are built for reference_dt, the weights scale them to the fed time step
+        self.dt_input = tf.placeholder(self.dtype,shape=[],name="dt")
+        self.tf_dt = tf.Variable(self.dt_input,trainable=False,name="dt_value")
+        self.H_weights = tf.multiply(tf.stack(self.weights_unpacked,-2),self.tf_dt/self.sys_para.reference_dt,name="packed_weights")
            
 
 
@@ -189,7 +515,7 @@ class TensorflowState:
         self.inter_states = []    
         for ii in range(self.sys_para.steps):
             self.inter_states.append(tf.zeros([2*self.sys_para.state_num,2*self.sys_para.state_num],
-                                              dtype=tf.float32,name="inter_state_"+str(ii)))
+                                              dtype=self.dtype,name="inter_state_"+str(ii)))
         print "Intermediate propagation variables initialized."
             
     def get_inter_state_op(self,layer):
@@ -201,8 +527,17 @@ class TensorflowState:
         
         return propagator    
         
+    def get_tf_matrix_list(self):
+        # matrices used in the propagation, only their values on the sparsity pattern with sparse storage
+        # and the packed local matrices with Kronecker structured operators
+        if self.sys_para.kron_operators:
+            return tf.constant(self.sys_para.kron_values,dtype=self.matrix_dtype)
+        if self.sys_para.sparse_storage:
+            return tf.constant(self.sys_para.sparse_values,dtype=self.matrix_dtype)
+        return tf.constant(self.sys_para.matrix_list,dtype=self.matrix_dtype)
+        
     def init_tf_propagator(self):
-        self.tf_matrix_list = tf.constant(self.sys_para.matrix_list,dtype=tf.float32)
+        self.tf_matrix_list = self.get_tf_matrix_list()
 
         # build propagator for all the intermediate states
        
@@ -220,12 +555,191 @@ class TensorflowState:
                                               b_is_sparse=self.sys_para.sparse_K)
             
         
-        self.final_state = self.inter_states[self.sys_para.steps-1]
+        self.final_state = self.to_real_mat(self.inter_states[self.sys_para.steps-1])
         
         self.unitary_scale = (0.5/self.sys_para.state_num)*tf.reduce_sum(tf.matmul(tf.transpose(self.final_state),self.final_state))
         
         print "Intermediate propagators initialized."
         
+    def init_tf_step_propagators(self):
+        self.tf_matrix_list = tf.constant(self.sys_para.matrix_list,dtype=self.matrix_dtype)
+        
+        # all the step propagators are computed with one batched matrix exponential
+        self.step_propagators = matexp_batch_op(self.H_weights,self.tf_matrix_list)
+        self.step_propagators.set_shape([self.sys_para.steps,self.propagation_dim,self.propagation_dim])
+        
+    def init_tf_propagator_scan(self):
+        self.init_tf_step_propagators()
+
+        # the step propagators are chained with a single scan over the time steps,
+        # so the graph size does not depend on the number of steps
+        def propagate(inter_state,propagator):
+            return tf.matmul(propagator,inter_state,a_is_sparse=self.sys_para.sparse_U,
+                             b_is_sparse=self.sys_para.sparse_K)
+        
+        # inter_states is packed as (steps, dim, dim)
+        self.inter_states = tf.scan(propagate,self.step_propagators,initializer=self.tf_initial_unitary,
+                                    name="inter_states")
+        
+        self.final_state = self.to_real_mat(self.inter_states[self.sys_para.steps-1])
+        
+        self.unitary_scale = (0.5/self.sys_para.state_num)*tf.reduce_sum(tf.matmul(tf.transpose(self.final_state),self.final_state))
+        
+        print "Intermediate propagators initialized."
+        
+    def init_tf_propagator_batch(self):
+        self.tf_matrix_list = self.get_tf_matrix_list()
+        steps = self.sys_para.steps
+        dim = self.propagation_dim
+        input_num = self.sys_para.ops_len+1
+        
+        # the step propagators of all the active problems are computed with one batched matrix exponential
+        weights = tf.reshape(tf.transpose(self.H_weights,[1,0,2]),[input_num,-1])
+        step_propagators = matexp_batch_op(weights,self.tf_matrix_list)
+        step_propagators = tf.transpose(tf.reshape(step_propagators,[-1,steps,dim,dim]),[1,0,2,3])
+        
+        # and chained with a scan over the time steps, each step is a batched matmul over the problems
+        def propagate(inter_state,propagator):
+            return tf.matmul(propagator,inter_state)
+        
+        initial_unitaries = tf.tile(tf.expand_dims(self.tf_initial_unitary,0),[tf.shape(weights)[1]/steps,1,1])
+        # inter_states is packed as (batch, steps, dim, dim)
+        self.inter_states = tf.transpose(tf.scan(propagate,step_propagators,initializer=initial_unitaries),
+                                         [1,0,2,3],name="inter_states")
+        
+        self.final_state = self.to_real_mat(self.inter_states[:,steps-1])
+        
+        self.unitary_scale = (0.5/self.sys_para.state_num)*tf.reduce_sum(
+            tf.matmul(self.final_state,self.final_state,transpose_a=True),[1,2])
+        
+        # the regularizations on the intermediate vectors are not supported
+        self.inter_vecs = None
+        
+        print "Intermediate propagators initialized."
+        
+    def init_tf_propagator_prefix(self):
+        self.init_tf_step_propagators()
+        steps = self.sys_para.steps
+        state_num = self.sys_para.state_num
+        dim = self.propagation_dim
+        
+        # time ordered product of the step propagators as a parallel prefix (Hillis-Steele) scan:
+        # after the pass with a given offset, prefix[ii] holds the product of the last 2*offset propagators up to step ii.
+        # The dependency depth is log2(steps) batched matmuls instead of steps sequential matmuls.
+        prefix = self.step_propagators
+        offset = 1
+        while offset < steps:
+            prefix = tf.concat([prefix[0:offset],tf.matmul(prefix[offset:steps],prefix[0:steps-offset])],0)
+            offset = 2*offset
+        
+        # inter_states is packed as (steps, dim, dim)
+        self.inter_states = tf.reshape(tf.matmul(tf.reshape(prefix,[steps*dim,dim]),self.tf_initial_unitary,
+                                                 b_is_sparse=self.sys_para.sparse_K),
+                                       [steps,dim,dim],name="inter_states")
+        
+        self.final_state = self.to_real_mat(self.inter_states[steps-1])
+        
+        self.unitary_scale = (0.5/state_num)*tf.reduce_sum(tf.matmul(tf.transpose(self.final_state),self.final_state))
+        
+        print "Intermediate propagators initialized."
+        
+    def init_tf_propagator_adjoint(self):
+        self.tf_matrix_list = tf.constant(self.sys_para.matrix_list,dtype=self.dtype)
+        
+        # the final state is propagated without keeping the intermediate propagators,
+        # its gradient is obtained from the backward propagation of the co-state
+        self.final_state = propagate_op(self.H_weights,self.tf_matrix_list,self.tf_initial_unitary)
+        self.final_state.set_shape([2*self.sys_para.state_num,2*self.sys_para.state_num])
+        
+        self.unitary_scale = (0.5/self.sys_para.state_num)*tf.reduce_sum(tf.matmul(tf.transpose(self.final_state),self.final_state))
+        
+        print "Intermediate propagators initialized."
+        
+    def init_tf_inter_vectors_adjoint(self):
+        # inter vectors for unitary evolution, recomputed step by step and excluded from the gradient
+        inter_vecs_steps = inter_vecs_op(tf.stop_gradient(self.H_weights),self.tf_matrix_list,self.tf_initial_unitary,
+                                         self.packed_initial_vectors)
+        inter_vecs_steps.set_shape([self.sys_para.steps,2*self.sys_para.state_num,len(self.sys_para.states_concerned_list)])
+        self.pack_inter_vecs(inter_vecs_steps)
+            
+        print "Vectors initialized."
+        
+    def pack_inter_vecs(self,inter_vecs_steps):
+        # pack vectors shaped as (steps, 2*state_num, number of vectors) together with the initial vectors
+        # into (2*state_num, steps+1, number of vectors)
+        self.inter_vecs_packed = tf.transpose(tf.concat([tf.expand_dims(self.packed_initial_vectors,0),inter_vecs_steps],0),
+                                              [1,0,2])
+        self.inter_vecs = tf.unstack(self.inter_vecs_packed, axis = 2)
+        
+    def init_tf_inter_vectors_packed(self):
+        # inter vectors for unitary evolution, obtained with one matmul over all the packed intermediate propagators
+        dim = self.propagation_dim
+        vec_num = len(self.sys_para.states_concerned_list)
+        
+        inter_vecs_steps = tf.matmul(tf.reshape(self.inter_states,[self.sys_para.steps*dim,dim]),
+                                     self.propagation_vectors)
+        self.pack_inter_vecs(self.to_real_vecs(tf.reshape(inter_vecs_steps,[self.sys_para.steps,dim,vec_num])))
+            
+        print "Vectors initialized."
+        
+    def get_segment_op(self,length):
+        # defun operator propagating a checkpoint segment of the given number of steps.
+        # Only the state entering the segment is kept for the backward pass, the segment is recomputed from it.
+        if length in self.segment_ops:
+            return self.segment_ops[length]
+        
+        def get_segment(weights,H_all,U,psi):
+            inter_vecs = []
+            for ii in range(length):
+                U = tf.matmul(matexp_op(weights[:,ii],H_all),U,a_is_sparse=self.sys_para.sparse_U,
+                              b_is_sparse=self.sys_para.sparse_K)
+                inter_vecs.append(tf.matmul(U,psi))
+            return U, tf.stack(inter_vecs)
+        
+        @function.Defun(self.dtype,self.dtype,self.dtype,self.dtype,self.dtype,self.dtype)
+        def segment_op_grad(weights,H_all,U,psi,grad_U,grad_inter_vecs):
+            # gradient of the segment, obtained by recomputing it from the checkpoint
+            U_final, inter_vecs = get_segment(weights,H_all,U,psi)
+            grads = tf.gradients([U_final,inter_vecs],[weights,U],grad_ys=[grad_U,grad_inter_vecs])
+            
+            return [grads[0], tf.zeros(tf.shape(H_all),dtype=self.dtype), grads[1], tf.zeros(tf.shape(psi),dtype=self.dtype)]
+        
+        @function.Defun(self.dtype,self.dtype,self.dtype,self.dtype, grad_func=segment_op_grad)
+        def segment_op(weights,H_all,U,psi):
+            # returns the final state of the segment and the inter vectors of all its steps
+            return get_segment(weights,H_all,U,psi)
+        
+        self.segment_ops[length] = segment_op
+        return segment_op
+        
+    def init_tf_propagator_checkpoint(self):
+        self.tf_matrix_list = tf.constant(self.sys_para.matrix_list,dtype=self.dtype)
+        self.segment_ops = {}
+        checkpoint_step = self.sys_para.checkpoint_step
+        state_num = self.sys_para.state_num
+        
+        # the propagation is split into segments of checkpoint_step steps,
+        # inter_states only holds the checkpoints at the end of every segment
+        self.inter_states = []
+        inter_vecs_segments = []
+        inter_state = self.tf_initial_unitary
+        for start in range(0,self.sys_para.steps,checkpoint_step):
+            length = min(checkpoint_step,self.sys_para.steps-start)
+            inter_state, inter_vecs_segment = self.get_segment_op(length)(self.H_weights[:,start:start+length],
+                                                                          self.tf_matrix_list,inter_state,
+                                                                          self.packed_initial_vectors)
+            inter_state.set_shape([2*state_num,2*state_num])
+            inter_vecs_segment.set_shape([length,2*state_num,len(self.sys_para.states_concerned_list)])
+            self.inter_states.append(inter_state)
+            inter_vecs_segments.append(inter_vecs_segment)
+        self.inter_vecs_segments = tf.concat(inter_vecs_segments,0)
+        
+        self.final_state = self.inter_states[-1]
+        
+        self.unitary_scale = (0.5/state_num)*tf.reduce_sum(tf.matmul(tf.transpose(self.final_state),self.final_state))
+        
+        print "Intermediate propagators initialized."
+        
     def init_tf_inter_vectors(self):
         # inter vectors for unitary evolution, obtained by multiplying the propagation operator K_j with initial vector
         self.inter_vecs_list =[]
@@ -234,7 +748,7 @@ class TensorflowState:
         self.inter_vecs_list.append(inter_vec)
         
         for ii in np.arange(0,self.sys_para.steps):               
-            inter_vec = tf.matmul(self.inter_states[ii],self.packed_initial_vectors,name="inter_vec_"+str(ii))
+            inter_vec = self.to_real_vecs(tf.matmul(self.inter_states[ii],self.propagation_vectors,name="inter_vec_"+str(ii)))
             self.inter_vecs_list.append(inter_vec)
         self.inter_vecs_packed = tf.stack(self.inter_vecs_list, axis=1)
         self.inter_vecs = tf.unstack(self.inter_vecs_packed, axis = 2)
@@ -244,22 +758,53 @@ class TensorflowState:
     def init_tf_inter_vector_state(self): 
         # inter vectors for state transfer, obtained by evolving the initial vector
 
-        tf_matrix_list = tf.constant(self.sys_para.matrix_list,dtype=tf.float32)
+        tf_matrix_list = self.get_tf_matrix_list()
         
         self.inter_vecs_list = []
-        inter_vec = self.packed_initial_vectors
-        self.inter_vecs_list.append(inter_vec)
+        self.inter_vecs_list.append(self.packed_initial_vectors)
+        inter_vec = self.propagation_vectors
         
         for ii in np.arange(0,self.sys_para.steps):
             psi = inter_vec               
             inter_vec = matvecexp_op(self.H_weights[:,ii],tf_matrix_list,psi)
-            self.inter_vecs_list.append(inter_vec)
+            self.inter_vecs_list.append(self.to_real_vecs(inter_vec))
         self.inter_vecs_packed = tf.stack(self.inter_vecs_list, axis=1)
         self.inter_vecs = tf.unstack(self.inter_vecs_packed, axis = 2)
         
             
         print "Vectors initialized."
         
+    def init_tf_inter_vector_state_scan(self): 
+        # inter vectors for state transfer, obtained by evolving the initial vector within a single scan
+
+        tf_matrix_list = self.get_tf_matrix_list()
+        
+        def propagate(psi,layer_weights):
+            new_psi = matvecexp_op(layer_weights,tf_matrix_list,psi)
+            new_psi.set_shape(psi.get_shape()) # defun outputs have no static shape
+            return new_psi
+        
+        inter_vecs_steps = tf.scan(propagate,tf.transpose(self.H_weights),initializer=self.propagation_vectors)
+        self.pack_inter_vecs(self.to_real_vecs(inter_vecs_steps))
+            
+        print "Vectors initialized."
+        
+    def init_tf_krylov_error(self):
+        # error estimate of the Krylov propagation, summed over the steps and maximized over the vectors.
+        # It is only evaluated when fetched and is excluded from the gradient.
+        state_num = self.sys_para.state_num
+        tf_matrix_list = self.get_tf_matrix_list()
+        weights = tf.stop_gradient(self.H_weights)
+        inter_vecs = tf.stop_gradient(self.inter_vecs_packed)
+        if self.sys_para.complex_propagation:
+            inter_vecs = tf.complex(inter_vecs[0:state_num],inter_vecs[state_num:2*state_num])
+        
+        def step_error(ii):
+            return self.get_krylov_error(weights[:,ii],tf_matrix_list,inter_vecs[:,ii,:])
+        
+        errors = tf.map_fn(step_error,tf.range(self.sys_para.steps),dtype=self.dtype)
+        self.krylov_error = tf.reduce_sum(tf.reduce_max(errors,1))
+        
     def get_inner_product(self,psi1,psi2):
         #Take 2 states psi1,psi2, calculate their overlap, for single vector
         state_num=self.sys_para.state_num
@@ -320,8 +865,40 @@ class TensorflowState:
             norm = (tf.add(reals,imags))/(len(self.sys_para.states_concerned_list)**2)
         return norm
     
+    def get_inner_product_batch(self,psi1,psi2):
+        #Take 2 states psi1,psi2, calculate their overlap for each problem of a batch
+        # psi1 and psi2 are shaped as (batch, 2*state_num, number of vectors)
+        state_num=self.sys_para.state_num
+        
+        psi_1_real = (psi1[:,0:state_num,:])
+        psi_1_imag = (psi1[:,state_num:2*state_num,:])
+        psi_2_real = (psi2[:,0:state_num,:])
+        psi_2_imag = (psi2[:,state_num:2*state_num,:])
+        # psi1 has a+ib, psi2 has c+id, we wanna get Sum ((ac+bd) + i (bc-ad)) magnitude
+        with tf.name_scope('inner_product'):
+            ac = tf.reduce_sum(tf.multiply(psi_1_real,psi_2_real),1)
+            bd = tf.reduce_sum(tf.multiply(psi_1_imag,psi_2_imag),1)
+            bc = tf.reduce_sum(tf.multiply(psi_1_imag,psi_2_real),1)
+            ad = tf.reduce_sum(tf.multiply(psi_1_real,psi_2_imag),1)
+            reals = tf.square(tf.reduce_sum(tf.add(ac,bd),1)) # first trace inner product of all vectors, then squared
+            imags = tf.square(tf.reduce_sum(tf.subtract(bc,ad),1))
+            norm = (tf.add(reals,imags))/(len(self.sys_para.states_concerned_list)**2)
+        return norm
+    
     def init_training_loss(self):
         # Adding all penalties
+        if self.sys_para.batch_size is not None:
+            # loss and reg_loss hold the loss of each problem
+            # explicit product of each final state with the initial vectors, tf.matmul only broadcasts from TF 1.14
+            self.final_vecs = tf.einsum('bij,jk->bik',self.final_state,self.packed_initial_vectors)
+            
+            self.loss = 1-self.get_inner_product_batch(self.final_vecs,tf.gather(self.target_vecs,self.active_indices))
+            
+            self.reg_loss = get_batch_reg_loss(self)
+            
+            print "Training loss initialized."
+            return
+            
         if self.sys_para.state_transfer == False:
             
             self.final_vecs = tf.matmul(self.final_state, self.packed_initial_vectors)
@@ -329,11 +906,23 @@ class TensorflowState:
             self.loss = 1-self.get_inner_product_2D(self.final_vecs,self.target_vecs)
         
         else:
-            self.loss = tf.constant(0.0, dtype = tf.float32)
+            self.loss = tf.constant(0.0, dtype = self.dtype)
             self.final_state = self.inter_vecs_packed[:,self.sys_para.steps,:]
             self.loss = 1-self.get_inner_product_2D(self.final_state,self.target_vecs)
             self.unitary_scale = self.get_inner_product_2D(self.final_state,self.final_state)
-            
+        
+        # gate error after each time step, from the intermediate vectors, only built when it is returned
+        self.error_trajectory = None
+        if self.sys_para.error_trajectory and self.inter_vecs is not None:
+            state_num = self.sys_para.state_num
+            psi = self.inter_vecs_packed[:,1:,:]
+            target = tf.expand_dims(self.target_vecs,1)
+            overlap_real = tf.reduce_sum(target[0:state_num]*psi[0:state_num] +
+                                         target[state_num:2*state_num]*psi[state_num:2*state_num],[0,2])
+            overlap_imag = tf.reduce_sum(target[0:state_num]*psi[state_num:2*state_num] -
+                                         target[state_num:2*state_num]*psi[0:state_num],[0,2])
+            self.error_trajectory = 1-(tf.square(overlap_real)+tf.square(overlap_imag))/(
+                len(self.sys_para.states_concerned_list)**2)
     
         self.reg_loss = get_reg_loss(self)
         
@@ -341,9 +930,19 @@ class TensorflowState:
             
     def init_optimizer(self):
         # Optimizer. Takes a variable learning rate.
-        self.learning_rate = tf.placeholder(tf.float32,shape=[])
+        self.learning_rate = tf.placeholder(self.dtype,shape=[])
         self.opt = tf.train.AdamOptimizer(learning_rate = self.learning_rate)
         
+        # intermediate vectors as one tensor, fetched with the losses for the saved snapshots
+        if self.inter_vecs is not None:
+            self.inter_vecs_stacked = tf.stack(self.inter_vecs)
+        else:
+            self.inter_vecs_stacked = None
+        
+        if self.sys_para.batch_size is not None:
+            self.init_batch_optimizer()
+            return
+        
         #Here we extract the gradients of the pulses
         self.grad = self.opt.compute_gradients(self.reg_loss)
 
@@ -353,16 +952,112 @@ class TensorflowState:
         self.grad_squared = tf.reduce_sum(tf.stack(self.grads))
         self.optimizer = self.opt.apply_gradients(self.grad)
         
+        # fused step: the update is applied after the losses and metrics fetched with it are evaluated, so a single
+        # session.run returns the values before the update. The snapshot step also waits for the saved tensors
+        # The weights are copied before the update, the variable is updated in place and fetching it returns the
+        # updated weights
+        self.ops_weight_evaluated = self.ops_weight_value + 0
+        evaluated = [self.loss, self.reg_loss, self.unitary_scale, self.grad_squared, self.ops_weight,
+                     self.ops_weight_evaluated]
+        if not self.sys_para.state_transfer:
+            evaluated.append(self.final_state)
+        with tf.control_dependencies(evaluated):
+            self.train_step = self.opt.apply_gradients(self.grad)
+        if self.inter_vecs_stacked is not None:
+            evaluated.append(self.inter_vecs_stacked)
+        if self.sys_para.expmv == 'krylov':
+            evaluated.append(self.krylov_error)
+        with tf.control_dependencies(evaluated):
+            self.train_step_snapshot = self.opt.apply_gradients(self.grad)
+        
+        # sets the weights, to go back to the weights evaluated by the last fused step
+        self.weights_input = tf.placeholder(self.dtype,shape=self.ops_weight_base.get_shape())
+        self.assign_weights = tf.assign(self.ops_weight_base,self.weights_input)
+        
+        # resets the moments of Adam, for a restart of the learning rate schedule
+        self.reset_optimizer = tf.variables_initializer(self.opt.variables())
+        
         print "Optimizer initialized."
     
+    def init_gauss_newton_product(self):
+        # product of the transposed Jacobian of the fidelity residual with a direction of the residual, for the
+        # Gauss-Newton products. Near the target the loss is close to |r|^2/n, with r the residual between the final
+        # vectors and the target vectors aligned on their global phase, so the Gauss-Newton matrix is 2/n J^T J.
+        # The custom gradients of the propagation have no gradient of their own, so J v is left to a finite
+        # difference of the residual. Only built for the LM method
+        state_num = self.sys_para.state_num
+        if self.sys_para.state_transfer:
+            psi = self.final_state
+        else:
+            psi = self.final_vecs
+        target_real = self.target_vecs[0:state_num]
+        target_imag = self.target_vecs[state_num:2*state_num]
+        
+        overlap_real = tf.reduce_sum(target_real*psi[0:state_num] + target_imag*psi[state_num:2*state_num])
+        overlap_imag = tf.reduce_sum(target_real*psi[state_num:2*state_num] - target_imag*psi[0:state_num])
+        overlap_norm = tf.sqrt(tf.square(overlap_real) + tf.square(overlap_imag))
+        phase_real = tf.stop_gradient(overlap_real/overlap_norm)
+        phase_imag = tf.stop_gradient(overlap_imag/overlap_norm)
+        self.residual = psi - tf.concat([phase_real*target_real - phase_imag*target_imag,
+                                         phase_real*target_imag + phase_imag*target_real],0)
+        
+        self.residual_direction = tf.placeholder(self.dtype,shape=self.residual.get_shape(),name="residual_direction")
+        self.gauss_newton_product = (2./len(self.sys_para.states_concerned_list))*tf.gradients(
+            self.residual,self.ops_weight_value,grad_ys=self.residual_direction)[0]
+    
+    def init_batch_optimizer(self):
+        # the problems are independent, so the gradient of the summed loss holds the gradient of each problem.
+        # Weights of the problems which are not active are set back to the fed frozen weights after each step.
+        self.frozen_weights = tf.placeholder(self.dtype,shape=np.shape(self.sys_para.ops_weight_base))
+        indices = tf.expand_dims(self.active_indices,1)
+        active_problems = tf.scatter_nd(indices,tf.ones_like(self.active_indices),[self.sys_para.batch_size]) > 0
+        
+        active_grad = tf.gradients(tf.reduce_sum(self.reg_loss),self.active_weight_base)[0]
+        self.grad = [(tf.scatter_nd(indices,active_grad,tf.shape(self.ops_weight_base)),self.ops_weight_base)]
+        
+        self.grad_pack = tf.stack([g for g, _ in self.grad])
+        
+        self.grad_squared = 0.5*tf.reduce_sum(tf.square(active_grad),[1,2])
+        with tf.control_dependencies([self.opt.apply_gradients(self.grad)]):
+            self.optimizer = tf.assign(self.ops_weight_base,tf.where(active_problems,self.ops_weight_base.read_value(),
+                                                                     self.frozen_weights))
+        
+        # fused step, as for a single problem: the update runs after the fetched losses and weights are evaluated
+        self.ops_weight_evaluated = self.ops_weight_base + 0
+        evaluated = [self.loss, self.reg_loss, self.unitary_scale, self.grad_squared, self.ops_weight,
+                     self.ops_weight_evaluated]
+        with tf.control_dependencies(evaluated):
+            update = self.opt.apply_gradients(self.grad)
+        with tf.control_dependencies([update]):
+            self.train_step = tf.assign(self.ops_weight_base,tf.where(active_problems,self.ops_weight_base.read_value(),
+                                                                      self.frozen_weights))
+        
+        self.weights_input = tf.placeholder(self.dtype,shape=self.ops_weight_base.get_shape())
+        self.assign_weights = tf.assign(self.ops_weight_base,self.weights_input)
+        self.reset_optimizer = tf.variables_initializer(self.opt.variables())
+        
+        print "Optimizer initialized."
+        
     def init_utilities(self):
         # Add ops to save and restore all the variables.
         self.saver = tf.train.Saver()
         
+        # initializes the variables with the fed target and initial guess
+        self.init_op = tf.global_variables_initializer()
+        
         print "Utilities initialized."
         
       
             
+    def init_feed_dict(self):
+        # values fed to init_op for the current system parameters
+        if self.sys_para.state_transfer:
+            target = np.array(self.sys_para.target_vectors)
+        else:
+            target = self.sys_para.target_unitary
+        return {self.target_input: target, self.initial_weights: self.sys_para.ops_weight_base,
+                self.dt_input: self.sys_para.dt}
+            
     def build_graph(self):
         # graph building for the quantum optimal control
         graph = tf.Graph()
@@ -375,17 +1070,49 @@ class TensorflowState:
             self.init_tf_vectors()
             self.init_tf_propagators()
             self.init_tf_ops_weight()
-            if self.sys_para.state_transfer == False:
-                self.init_tf_inter_propagators()
-                self.init_tf_propagator()
-                if self.sys_para.use_inter_vecs:
-                    self.init_tf_inter_vectors()
+            if self.sys_para.batch_size is not None:
+                self.init_tf_propagator_batch()
+            elif self.sys_para.state_transfer == False:
+                if self.sys_para.propagation == 'unrolled' and self.sys_para.checkpoint_step is not None:
+                    self.init_tf_propagator_checkpoint()
+                    if self.sys_para.use_inter_vecs:
+                        self.pack_inter_vecs(self.inter_vecs_segments)
+                        print "Vectors initialized."
+                    else:
+                        self.inter_vecs = None
+                elif self.sys_para.propagation == 'unrolled':
+                    self.init_tf_inter_propagators()
+                    self.init_tf_propagator()
+                    if self.sys_para.use_inter_vecs:
+                        self.init_tf_inter_vectors()
+                    else:
+                        self.inter_vecs = None
+                elif self.sys_para.propagation == 'adjoint':
+                    self.init_tf_propagator_adjoint()
+                    if self.sys_para.use_inter_vecs:
+                        self.init_tf_inter_vectors_adjoint()
+                    else:
+                        self.inter_vecs = None
                 else:
-                    self.inter_vecs = None
+                    if self.sys_para.propagation == 'scan':
+                        self.init_tf_propagator_scan()
+                    else:
+                        self.init_tf_propagator_prefix()
+                    if self.sys_para.use_inter_vecs:
+                        self.init_tf_inter_vectors_packed()
+                    else:
+                        self.inter_vecs = None
             else:
-                self.init_tf_inter_vector_state()
+                if self.sys_para.propagation == 'scan':
+                    self.init_tf_inter_vector_state_scan()
+                else:
+                    self.init_tf_inter_vector_state()
+                if self.sys_para.expmv == 'krylov':
+                    self.init_tf_krylov_error()
             self.init_training_loss()
             self.init_optimizer()
+            if self.sys_para.method == 'LM':
+                self.init_gauss_newton_product()
             self.init_utilities()
          
             
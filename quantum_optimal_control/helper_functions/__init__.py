@@ -2,3 +2,5 @@
 from data_management import *
 from grape_functions import * 
 from qutip_verification import * 
+from kron_operator import *
+from pulse_library import *
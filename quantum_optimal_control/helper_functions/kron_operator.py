@@ -0,0 +1,91 @@
+import numpy as np
+
+
+def apply_local(matrix, targets, X, levels):
+    # apply a local matrix acting on the target subsystems to X, whose leading axes index the subsystems.
+    # The local matrix is contracted with the target axes, the result axes are moved back in place.
+    k = len(targets)
+    Y = np.tensordot(np.reshape(matrix, [levels]*(2*k)), X, axes=(range(k, 2*k), targets))
+    axes = list(targets) + [a for a in range(X.ndim) if a not in targets]
+    return np.transpose(Y, np.argsort(axes))
+
+
+class KronOperator:
+    # operator on a register of subsystems, stored as a sum of terms (local matrix, target subsystems)
+    # with the identity on all the other subsystems. Applying a term costs O(levels^k * dim) instead of O(dim^2)
+
+    def __init__(self, subsystem_num, levels=2, terms=None):
+        self.subsystem_num = subsystem_num
+        self.levels = levels
+        self.dim = levels**subsystem_num
+        self.terms = []
+        if terms is not None:
+            for matrix, targets in terms:
+                self.add_term(matrix, targets)
+
+    @classmethod
+    def from_dense(cls, matrix, subsystem_num, levels=2):
+        # a dense operator is a single term acting on all the subsystems, a zero matrix has no terms
+        op = cls(subsystem_num, levels)
+        if np.any(matrix != 0):
+            op.add_term(matrix, range(subsystem_num))
+        return op
+
+    def add_term(self, matrix, targets):
+        targets = tuple(targets)
+        matrix = np.array(matrix, dtype=complex)
+        if len(set(targets)) != len(targets) or min(targets) < 0 or max(targets) >= self.subsystem_num:
+            raise ValueError('Invalid target subsystems: %s' % (targets,))
+        if matrix.shape != (self.levels**len(targets), self.levels**len(targets)):
+            raise ValueError('Local matrix of shape %s does not act on %d subsystems' % (matrix.shape, len(targets)))
+
+        # terms acting on the same subsystems are merged, so they are applied with a single contraction
+        for ii, (term_matrix, term_targets) in enumerate(self.terms):
+            if term_targets == targets:
+                self.terms[ii] = (term_matrix + matrix, targets)
+                return
+        self.terms.append((matrix, targets))
+
+    def __len__(self):
+        return self.dim
+
+    @property
+    def shape(self):
+        return (self.dim, self.dim)
+
+    def __add__(self, other):
+        if np.isscalar(other) and other == 0:
+            return self
+        if not isinstance(other, KronOperator) or other.subsystem_num != self.subsystem_num or other.levels != self.levels:
+            raise ValueError('Only operators on the same register can be added')
+        return KronOperator(self.subsystem_num, self.levels, self.terms + other.terms)
+
+    __radd__ = __add__
+
+    def __mul__(self, scalar):
+        return KronOperator(self.subsystem_num, self.levels, [(scalar*matrix, targets) for matrix, targets in self.terms])
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return -1*self
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def dot(self, psi):
+        # product with a vector or a matrix whose first axis spans the register
+        psi = np.asarray(psi)
+        X = np.reshape(psi, [self.levels]*self.subsystem_num + [-1])
+        result = np.zeros(X.shape, dtype=complex)
+        for matrix, targets in self.terms:
+            result += apply_local(matrix, targets, X, self.levels)
+        return np.reshape(result, psi.shape)
+
+    def full(self):
+        # dense matrix of the operator
+        return self.dot(np.identity(self.dim, dtype=complex))
+
+    def max_abs(self):
+        # upper bound on the largest magnitude of the dense matrix entries
+        return sum([np.max(np.abs(matrix)) for matrix, targets in self.terms])
@@ -0,0 +1,283 @@
+import os
+import hashlib
+import itertools
+import uuid
+import numpy as np
+import h5py
+
+from quantum_optimal_control.helper_functions.data_management import H5File
+from quantum_optimal_control.helper_functions.kron_operator import KronOperator
+
+
+def dense_operator(op):
+    # dense complex matrix of an operator
+    if isinstance(op, KronOperator):
+        return op.full()
+    return np.array(op, dtype=complex)
+
+
+def unitary_distance(U, V):
+    # distance between two unitaries up to a global phase, 0 for equal unitaries and 1 for orthogonal ones
+    return 1 - np.abs(np.trace(np.dot(np.conjugate(np.transpose(U)), V))) / len(U)
+
+
+def permute_qubits(M, perm, qubit_num):
+    # conjugation of M by a permutation of the subsystems: subsystem ii of the result is subsystem perm[ii] of M
+    levels = int(round(len(M)**(1. / qubit_num)))
+    axes = list(perm) + [qubit_num + ii for ii in perm]
+    return np.reshape(np.transpose(np.reshape(M, [levels] * (2 * qubit_num)), axes), np.shape(M))
+
+
+def register_size(dim):
+    # number of qubits of a register of dimension dim, a register which is not made of qubits is one subsystem
+    qubit_num = int(round(np.log2(dim)))
+    if 2**qubit_num == dim:
+        return qubit_num
+    return 1
+
+
+def resample_pulses(uks, steps, time_ratio=1., maxA=None):
+    # pulses uks, sampled at the middle of their time steps, interpolated on steps time steps of the same
+    # normalized duration. For a gate time stretched by 1/time_ratio the amplitudes are scaled by time_ratio,
+    # so the pulse areas are kept, and clipped to maxA
+    uks = np.array(uks, dtype=float)
+    old_times = (np.arange(np.shape(uks)[-1]) + 0.5) / np.shape(uks)[-1]
+    new_times = (np.arange(steps) + 0.5) / steps
+    new_uks = time_ratio * np.array([np.interp(new_times, old_times, uk) for uk in uks])
+    if maxA is not None:
+        maxA = np.reshape(np.array(maxA, dtype=float) * np.ones(len(new_uks)), [-1, 1])
+        new_uks = np.clip(new_uks, -maxA, maxA)
+    return new_uks
+
+
+def device_key(H0, Hops, maxA):
+    # fingerprint of a device, given by its drift and control Hamiltonians and the maximum amplitudes
+    sha = hashlib.sha1()
+    for op in [H0] + list(Hops) + [np.array(maxA, dtype=float)]:
+        sha.update(np.ascontiguousarray(np.round(dense_operator(op), 10) + 0.).tostring())
+    return sha.hexdigest()
+
+
+def control_permutation(H0, Hops, maxA, perm, qubit_num):
+    # permutation of the controls under the permutation perm of the qubits, None when perm does not leave the
+    # device invariant: the permuted control ii is the control sigma[ii]
+    if not np.allclose(permute_qubits(H0, perm, qubit_num), H0):
+        return None
+    sigma = []
+    for ii in range(len(Hops)):
+        op = permute_qubits(Hops[ii], perm, qubit_num)
+        match = [jj for jj in range(len(Hops)) if jj not in sigma and maxA[jj] == maxA[ii]
+                 and np.allclose(op, Hops[jj])]
+        if len(match) == 0:
+            return None
+        sigma.append(match[0])
+    return sigma
+
+
+def compose_symmetries(first, second):
+    # relabeling by the symmetry first, then by second
+    return tuple([first[0][ii] for ii in second[0]]), [second[1][ii] for ii in first[1]]
+
+
+def device_symmetries(H0, Hops, maxA, qubit_num, generators=None):
+    # permutations of the qubits which leave the device invariant, together with the permutation of the controls,
+    # as the group generated by the qubit permutations generators. By default the generators are the transpositions
+    # which leave the device invariant, so only qubit_num**2 permutations are checked
+    H0 = dense_operator(H0)
+    Hops = [dense_operator(op) for op in Hops]
+    if generators is None:
+        generators = []
+        for ii, jj in itertools.combinations(range(qubit_num), 2):
+            perm = range(qubit_num)
+            perm[ii], perm[jj] = jj, ii
+            if control_permutation(H0, Hops, maxA, perm, qubit_num) is not None:
+                generators.append(perm)
+
+    symmetries = []
+    for perm in generators:
+        sigma = control_permutation(H0, Hops, maxA, perm, qubit_num)
+        if sigma is None:
+            raise ValueError('The device is not invariant under the qubit permutation %s' % (list(perm),))
+        symmetries.append((tuple(perm), sigma))
+
+    # closure of the generators, starting from the identity
+    group = [(tuple(range(qubit_num)), range(len(Hops)))]
+    perms = set([group[0][0]])
+    ii = 0
+    while ii < len(group):
+        for generator in symmetries:
+            symmetry = compose_symmetries(group[ii], generator)
+            if symmetry[0] not in perms:
+                perms.add(symmetry[0])
+                group.append(symmetry)
+        ii += 1
+    return group
+
+
+def remove_global_phase(U):
+    # U with the phase of a fixed random combination of its elements removed. Unlike the phase of a pivot element,
+    # it is continuous in U
+    weights = np.random.RandomState(0).uniform(1, 2, np.size(U))
+    phase = np.dot(weights, np.ravel(U))
+    if np.abs(phase) == 0:
+        return U
+    return U * np.conjugate(phase) / np.abs(phase)
+
+
+def target_fingerprint(U, symmetries, qubit_num, decimals=6):
+    # fingerprint of a target, equal for the targets which are the same up to a global phase and a qubit relabeling
+    # in symmetries, once rounded to decimals. The smallest of the relabeled targets stands for all of them.
+    # Close targets can round differently, so the fingerprint is only used to find the exact matches first
+    U = np.array(U, dtype=complex)
+    relabeled = []
+    for perm, sigma in symmetries:
+        M = np.round(remove_global_phase(permute_qubits(U, perm, qubit_num)), decimals) + 0.
+        relabeled.append(np.ascontiguousarray(M).tostring())
+    return hashlib.sha1(min(relabeled)).hexdigest()
+
+
+class PulseLibrary:
+    # persistent library of optimized pulses, stored in an HDF5 file.
+    # A pulse is found again for a target equal to its own up to a global phase and a relabeling of the qubits,
+    # on the same device and for the same gate time. The qubit relabelings are the ones the device is symmetric
+    # under, generated by its symmetric transpositions or given with set_symmetries, the controls of the pulse are
+    # relabeled accordingly.
+    # Only the attributes of the entries are read when the library is opened. They are indexed by device and target
+    # fingerprint, and the unitaries and pulses are read for the entries a search looks at. The symmetries of each
+    # device are stored in the file.
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.entries = {}
+        self.index = {}
+        self.devices = {}
+        self.symmetries = {}
+
+        if os.path.exists(self.file_path):
+            with h5py.File(self.file_path, 'r') as hf:
+                if 'symmetries' in hf:
+                    for name, group in hf['symmetries'].items():
+                        self.symmetries[name] = zip([tuple(perm) for perm in np.array(group['perms'])],
+                                                    [list(sigma) for sigma in np.array(group['sigmas'])])
+                for name in hf.keys():
+                    if name.startswith('pulse_'):
+                        self.index_entry(name, dict(hf[name].attrs))
+
+    def index_entry(self, name, entry):
+        entry['name'] = name
+        self.entries[name] = entry
+        device = (entry['device_key'], entry['qubit_num'])
+        self.devices.setdefault(device, []).append(name)
+        self.index.setdefault(device + (entry['fingerprint'],), []).append(name)
+
+    def read(self, name, dataset):
+        with h5py.File(self.file_path, 'r') as hf:
+            return np.array(hf[name][dataset])
+
+    def get_symmetries(self, key, H0, Hops, maxA, qubit_num):
+        name = '%s_%d' % (key, qubit_num)
+        if name not in self.symmetries:
+            self.symmetries[name] = device_symmetries(H0, Hops, maxA, qubit_num)
+        return name, self.symmetries[name]
+
+    def set_symmetries(self, H0, Hops, maxA, qubit_num, generators):
+        # the symmetries of a device are the group generated by the qubit permutations generators. The entries added
+        # before keep their fingerprints, they are still found by the scan of lookup
+        key = device_key(H0, Hops, maxA)
+        name = '%s_%d' % (key, qubit_num)
+        self.symmetries[name] = device_symmetries(H0, Hops, maxA, qubit_num, generators)
+        with H5File(self.file_path, 'a') as hf:
+            if 'symmetries/' + name in hf:
+                del hf['symmetries/' + name]
+            self.write_symmetries(hf, name)
+
+    def write_symmetries(self, hf, name):
+        group = hf.create_group('symmetries/' + name)
+        group.create_dataset('perms', data=np.array([perm for perm, sigma in self.symmetries[name]]))
+        group.create_dataset('sigmas', data=np.array([sigma for perm, sigma in self.symmetries[name]]))
+
+    def add(self, H0, Hops, maxA, qubit_num, total_time, U, uks, error, file_path=''):
+        # store the pulses uks, reaching U with the final error
+        key = device_key(H0, Hops, maxA)
+        symmetries_name, symmetries = self.get_symmetries(key, H0, Hops, maxA, qubit_num)
+        entry = {'device_key': key, 'qubit_num': qubit_num, 'total_time': float(total_time),
+                 'steps': np.shape(uks)[-1], 'error': float(error), 'file_path': str(file_path),
+                 'fingerprint': target_fingerprint(U, symmetries, qubit_num)}
+
+        # the group names are unique, so libraries opened on the same file do not write the same group
+        name = 'pulse_' + uuid.uuid4().hex
+        with H5File(self.file_path, 'a') as hf:
+            if 'symmetries/' + symmetries_name not in hf:
+                self.write_symmetries(hf, symmetries_name)
+            group = hf.create_group(name)
+            for k in entry.keys():
+                group.attrs[k] = entry[k]
+            group.create_dataset('U', data=np.array(U, dtype=complex))
+            group.create_dataset('uks', data=np.array(uks))
+        self.index_entry(name, entry)
+
+    def matches(self, names, U, qubit_num, symmetries):
+        # the entries names, with their smallest unitary distance to U over the device symmetries, and the
+        # permutation of the controls of this relabeling
+        for name in names:
+            entry = self.entries[name]
+            if 'U' not in entry:
+                entry['U'] = self.read(name, 'U')
+            distance = None
+            for perm, sigma in symmetries:
+                perm_distance = unitary_distance(permute_qubits(entry['U'], perm, qubit_num), U)
+                if distance is None or perm_distance < distance:
+                    distance = perm_distance
+                    best_sigma = sigma
+            yield entry, distance, best_sigma
+
+    def relabeled_pulses(self, entry, sigma):
+        uks = self.read(entry['name'], 'uks')
+        relabeled = np.zeros_like(uks)
+        relabeled[sigma] = uks
+        return relabeled
+
+    def lookup(self, H0, Hops, maxA, qubit_num, total_time, U, tolerance=1e-6):
+        # pulses with the lowest error among the entries reaching U within the unitary distance tolerance.
+        # The entries with the fingerprint of U are looked at first, the other entries of the device are only scanned
+        # when none of them is within tolerance, as targets within tolerance can have different fingerprints.
+        # Returns a dictionary with the 'uks', 'steps', 'error', 'distance' and 'file_path', or None
+        key = device_key(H0, Hops, maxA)
+        symmetries_name, symmetries = self.get_symmetries(key, H0, Hops, maxA, qubit_num)
+        bucket = self.index.get((key, qubit_num, target_fingerprint(U, symmetries, qubit_num)), [])
+        others = [name for name in self.devices.get((key, qubit_num), []) if name not in bucket]
+        best = None
+        for names in [bucket, others]:
+            names = [name for name in names if np.isclose(self.entries[name]['total_time'], total_time)]
+            for entry, distance, sigma in self.matches(names, U, qubit_num, symmetries):
+                if distance < tolerance and (best is None or entry['error'] < best[0]['error']):
+                    best = (entry, distance, sigma)
+            if best is not None:
+                break
+        if best is None:
+            return None
+        entry, distance, sigma = best
+        return {'uks': self.relabeled_pulses(entry, sigma), 'steps': entry['steps'], 'error': entry['error'],
+                'distance': distance, 'file_path': entry['file_path']}
+
+    def nearest(self, H0, Hops, maxA, qubit_num, total_time, U, time_weight=0.1, max_distance=0.5):
+        # nearest pulses to a target U and a gate time total_time on the same device, for a warm start.
+        # The score of an entry is its unitary distance plus time_weight times the relative gate time difference,
+        # entries further than max_distance from U are not used.
+        # Returns a dictionary with the 'uks', 'steps', 'total_time', 'error', 'distance', 'score' and 'file_path',
+        # or None
+        key = device_key(H0, Hops, maxA)
+        symmetries_name, symmetries = self.get_symmetries(key, H0, Hops, maxA, qubit_num)
+        best = None
+        for entry, distance, sigma in self.matches(self.devices.get((key, qubit_num), []), U, qubit_num,
+                                                   symmetries):
+            if distance > max_distance:
+                continue
+            score = distance + time_weight * abs(entry['total_time'] - total_time) / total_time
+            if best is None or score < best[3] or (score == best[3] and entry['error'] < best[0]['error']):
+                best = (entry, distance, sigma, score)
+        if best is None:
+            return None
+        entry, distance, sigma, score = best
+        return {'uks': self.relabeled_pulses(entry, sigma), 'steps': entry['steps'], 'total_time': entry['total_time'],
+                'error': entry['error'], 'distance': distance, 'score': score, 'file_path': entry['file_path']}
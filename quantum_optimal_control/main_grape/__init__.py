@@ -1,2 +1,3 @@
 #IMPORTS 
-from grape import *
\ No newline at end of file
+from grape import *
+from continuation import *
@@ -0,0 +1,107 @@
+import numpy as np
+
+from quantum_optimal_control.main_grape.grape import Grape
+from quantum_optimal_control.helper_functions.pulse_library import resample_pulses
+
+
+def continuation_search(H0, Hops, Hnames, U, min_time, max_time, steps, states_concerned_list, time_tolerance=None,
+                        initial_guess=None, **grape_args):
+    """
+    - Binary search of the shortest gate time in [min_time, max_time] for which Grape reaches the conv_target.
+    - The optimization runs first at max_time, every following run starts from the pulses of the shortest gate
+      time reached so far, rescaled to the new gate time. The number of steps is kept, so all the runs use the
+      same compiled graph, only the time step changes.
+    - The search stops when the interval is shorter than time_tolerance, by default one time step at max_time.
+    - grape_args are passed to Grape.
+    - Returns a dictionary with the shortest 'total_time' reached, its pulses 'uks', final unitary 'Uf' and 'error',
+      and the list of (total_time, error) of all the 'runs'. 'total_time' is None when max_time is not reached.
+    """
+
+    if min_time <= 0 or min_time >= max_time:
+        raise ValueError('continuation_search requires 0 < min_time < max_time')
+    if time_tolerance is None:
+        time_tolerance = float(max_time) / steps
+
+    conv_target = 1e-8
+    if 'convergence' in grape_args and 'conv_target' in grape_args['convergence']:
+        conv_target = grape_args['convergence']['conv_target']
+    maxA = grape_args.get('maxA')
+    grape_args.update({'max_total_time': max_time, 'cache_graph': True, 'return_error': True})
+
+    result = {'total_time': None, 'uks': None, 'Uf': None, 'error': None, 'runs': []}
+    low = float(min_time)
+    high = float(max_time)
+    total_time = high
+    while True:
+        uks, Uf, error = Grape(H0, Hops, Hnames, U, total_time, steps, states_concerned_list,
+                               initial_guess=initial_guess, **grape_args)
+        result['runs'].append((total_time, error))
+        print "Gate time %s: error = %1.2e" % (total_time, error)
+
+        if error <= conv_target:
+            high = total_time
+            result.update({'total_time': total_time, 'uks': np.array(uks), 'Uf': Uf, 'error': error})
+        elif result['total_time'] is None:
+            # max_time is not reached, there is nothing to search
+            return result
+        else:
+            low = total_time
+
+        if high - low <= time_tolerance:
+            return result
+
+        # continue from the shortest successful pulses, with the same pulse areas at the new gate time
+        total_time = 0.5 * (low + high)
+        initial_guess = resample_pulses(result['uks'], steps, result['total_time'] / total_time, maxA)
+
+
+def find_min_time(H0, Hops, Hnames, U, max_time, steps, states_concerned_list, min_time=None, speed_up=1.0,
+                  time_tolerance=None, **grape_args):
+    """
+    - Shortest gate time, up to max_time, for which Grape reaches the conv_target.
+    - A first optimization at max_time adds the speed_up regularization, which rewards reaching the target early.
+      The first time step where the gate error of its pulses passes the conv_target is an estimate of the
+      shortest gate time.
+    - continuation_search then bisects between min_time, by default half of the estimate, and the estimate,
+      starting from the pulses up to the estimate. When the estimate is not confirmed it bisects between the
+      estimate and max_time instead.
+    - grape_args are passed to Grape.
+    - Returns the dictionary of continuation_search, with the 'estimated_time' of the speed_up run.
+    """
+
+    conv_target = 1e-8
+    if 'convergence' in grape_args and 'conv_target' in grape_args['convergence']:
+        conv_target = grape_args['convergence']['conv_target']
+    maxA = grape_args.get('maxA')
+
+    speed_up_args = dict(grape_args)
+    reg_coeffs = speed_up_args.get('reg_coeffs')
+    speed_up_args['reg_coeffs'] = dict({} if reg_coeffs is None else reg_coeffs, speed_up=speed_up)
+    speed_up_args.update({'use_inter_vecs': True, 'return_error': True, 'return_error_trajectory': True})
+    uks, Uf, error, errors = Grape(H0, Hops, Hnames, U, max_time, steps, states_concerned_list, **speed_up_args)
+    if error > conv_target:
+        return {'total_time': None, 'uks': None, 'Uf': None, 'error': None, 'runs': [(max_time, error)],
+                'estimated_time': None}
+
+    reached = int(np.argmax(errors <= conv_target)) + 1
+    if errors[reached - 1] > conv_target:
+        # the target is only reached within the accuracy of the optimization, at the end of the pulses
+        reached = steps
+    estimated_time = float(max_time) * reached / steps
+    print "Estimated gate time: %s" % (estimated_time)
+
+    if min_time is None:
+        min_time = 0.5 * estimated_time
+    result = None
+    if estimated_time > min_time:
+        result = continuation_search(H0, Hops, Hnames, U, min_time, estimated_time, steps, states_concerned_list,
+                                     time_tolerance, resample_pulses(np.array(uks)[:, :reached], steps, 1., maxA),
+                                     **grape_args)
+    if (result is None or result['total_time'] is None) and estimated_time < max_time:
+        result = continuation_search(H0, Hops, Hnames, U, estimated_time, max_time, steps, states_concerned_list,
+                                     time_tolerance, np.array(uks), **grape_args)
+    if result is None or result['total_time'] is None:
+        result = {'total_time': max_time, 'uks': np.array(uks), 'Uf': Uf, 'error': error,
+                  'runs': [(max_time, error)]}
+    result['estimated_time'] = estimated_time
+    return result
@@ -5,6 +5,8 @@ from quantum_optimal_control.core.tensorflow_state import TensorflowState
 from quantum_optimal_control.core.system_parameters import SystemParameters
 from quantum_optimal_control.core.convergence import Convergence
 from quantum_optimal_control.core.run_session import run_session
+from quantum_optimal_control.core.run_session import session_config
+from quantum_optimal_control.core.run_session import batch_run_session
 
 
 
@@ -13,10 +15,25 @@ import time
 from IPython import display
 
 from quantum_optimal_control.helper_functions.data_management import H5File
+from quantum_optimal_control.helper_functions.kron_operator import KronOperator
+from quantum_optimal_control.helper_functions.pulse_library import PulseLibrary, register_size, resample_pulses
 import os
+from collections import OrderedDict
 
 
-def Grape(H0,Hops,Hnames,U,total_time,steps,states_concerned_list,convergence = None, U0= None, reg_coeffs = None,dressed_info = None, maxA = None ,use_gpu= True, sparse_H=True,sparse_U=False,sparse_K=False,draw= None, initial_guess = None,show_plots = True, unitary_error=1e-4, method = 'Adam',state_transfer = False,no_scaling = False, freq_unit = 'GHz', file_name = None, save = True, data_path = None, Taylor_terms = None, use_inter_vecs=True, circuit_name="circuit"):
+# graphs and open sessions of previous Grape calls, keyed by the system they were built for
+graph_cache = OrderedDict()
+graph_cache_size = 8
+
+
+def clear_graph_cache():
+    # close the cached sessions and drop the cached graphs
+    for tfs, graph, session in graph_cache.values():
+        session.close()
+    graph_cache.clear()
+
+
+def Grape(H0,Hops,Hnames,U,total_time,steps,states_concerned_list,convergence = None, U0= None, reg_coeffs = None,dressed_info = None, maxA = None ,use_gpu= True, sparse_H=True,sparse_U=False,sparse_K=False,draw= None, initial_guess = None,show_plots = True, unitary_error=1e-4, method = 'Adam',state_transfer = False,no_scaling = False, freq_unit = 'GHz', file_name = None, save = True, data_path = None, Taylor_terms = None, use_inter_vecs=True, circuit_name="circuit", propagation=None, checkpoint_step=None, complex_propagation=False, precision='float32', expmv='taylor', sparse_storage=False, cache_graph=False, max_total_time=None, batch=False, multi_start=None, num_threads=None, pulse_library=None, return_error=False, return_status=False, return_error_trajectory=False, return_file_path=False):
     
     # start time
     grape_start_time = time.time()
@@ -31,8 +48,34 @@ def Grape(H0,Hops,Hnames,U,total_time,steps,states_concerned_list,convergence =
         sparse_U = False
         sparse_K = False
     
+    # batches of problems, and the starts of multi_start, are only propagated with scan. A single problem is
+    # unrolled by default
+    if propagation is None:
+        if batch or multi_start is not None:
+            propagation = 'scan'
+        else:
+            propagation = 'unrolled'
+    
     file_path = None
     
+    library = None
+    if return_error_trajectory and (batch or multi_start is not None or not use_inter_vecs):
+        raise ValueError('return_error_trajectory is only supported for a single problem with use_inter_vecs')
+    
+    if pulse_library is not None:
+        # library of optimized pulses, the pulses found by this optimization are added to it
+        if state_transfer or batch:
+            raise ValueError('pulse_library is only supported for the optimization of a single unitary')
+        if maxA is None:
+            raise ValueError('pulse_library requires maxA, which is part of the device the pulses are stored for')
+        library = PulseLibrary(pulse_library)
+        if initial_guess is None:
+            # warm start from the stored pulses nearest to the target and the gate time
+            nearest = library.nearest(H0,Hops,maxA,register_size(len(H0)),total_time,U)
+            if nearest is not None:
+                initial_guess = resample_pulses(nearest['uks'],steps,nearest['total_time']/total_time,maxA)
+                print "Initial guess from " + str(nearest['file_path']) + ": unitary distance = %.2e, time = %s" %(nearest['distance'],nearest['total_time'])
+    
     if save:
         # saves all the input values
         if file_name is None:
@@ -53,17 +96,32 @@ def Grape(H0,Hops,Hnames,U,total_time,steps,states_concerned_list,convergence =
         print "data saved at: " + str(file_path)
 
         with H5File(file_path) as hf:
-            hf.add('H0',data=H0)
-            hf.add('Hops',data=Hops)
+            # Kronecker structured operators are not saved as dense matrices
+            if not isinstance(H0,KronOperator):
+                hf.add('H0',data=H0)
+            if not any([isinstance(op,KronOperator) for op in Hops]):
+                hf.add('Hops',data=Hops)
             hf.add('Hnames',data=Hnames)
             hf.add('U',data=U)
             hf.add('total_time', data=total_time)
+            if not max_total_time is None:
+                hf.add('max_total_time', data=max_total_time)
             hf.add('steps', data=steps)
             hf.add('states_concerned_list', data=states_concerned_list)
             hf.add('use_gpu',data=use_gpu)
             hf.add('sparse_H',data=sparse_H)
             hf.add('sparse_U',data=sparse_U)
             hf.add('sparse_K',data=sparse_K)
+            hf.add('propagation',data=propagation)
+            if not checkpoint_step is None:
+                hf.add('checkpoint_step',data=checkpoint_step)
+            hf.add('complex_propagation',data=complex_propagation)
+            hf.add('precision',data=precision)
+            hf.add('expmv',data=expmv)
+            hf.add('sparse_storage',data=sparse_storage)
+            hf.add('batch',data=batch)
+            if not multi_start is None:
+                hf.add('multi_start',data=multi_start)
             
             if not maxA is None:
                 hf.add('maxA', data=maxA)
@@ -100,8 +158,27 @@ def Grape(H0,Hops,Hnames,U,total_time,steps,states_concerned_list,convergence =
     else:
         maxAmp = maxA
     
+    batch_size = None
+    targets = U
+    if batch:
+        batch_size = len(U)
+    if multi_start is not None:
+        if batch:
+            raise ValueError('multi_start is not supported with batch optimization')
+        # the starts are optimized as a batch of copies of the same problem, from the initial guess and random pulses
+        batch_size = multi_start
+        targets = [U]*multi_start
+        if initial_guess is not None:
+            random_base = np.random.normal(0, 1./np.sqrt(steps), [multi_start-1,len(Hops),steps])
+            random_starts = np.reshape(maxAmp,[1,-1,1])*np.sin(random_base)
+            initial_guess = np.concatenate([[initial_guess],random_starts])
+    
     # pass in system parameters
-    sys_para = SystemParameters(H0,Hops,Hnames,U,U0,total_time,steps,states_concerned_list,dressed_info,maxAmp, draw,initial_guess,  show_plots,unitary_error,state_transfer,no_scaling,reg_coeffs, save, file_path, Taylor_terms, use_gpu, use_inter_vecs,sparse_H,sparse_U,sparse_K,circuit_name)
+    sys_para = SystemParameters(H0,Hops,Hnames,targets,U0,total_time,steps,states_concerned_list,dressed_info,maxAmp, draw,initial_guess,  show_plots,unitary_error,state_transfer,no_scaling,reg_coeffs, save, file_path, Taylor_terms, use_gpu, use_inter_vecs,sparse_H,sparse_U,sparse_K,circuit_name,propagation=propagation,
+                                checkpoint_step=checkpoint_step,complex_propagation=complex_propagation,
+                                precision=precision,expmv=expmv,sparse_storage=sparse_storage,
+                                max_total_time=max_total_time,batch_size=batch_size,num_threads=num_threads,
+                                error_trajectory=return_error_trajectory,method=method)
     
     if use_gpu:
         dev = '/gpu:0'
@@ -109,15 +186,51 @@ def Grape(H0,Hops,Hnames,U,total_time,steps,states_concerned_list,convergence =
         dev = '/cpu:0'
         
         
-    with tf.device(dev):
-        tfs = TensorflowState(sys_para) # create tensorflow graph
-        graph = tfs.build_graph()
+    session = None
+    if cache_graph:
+        key = (dev,) + sys_para.graph_key()
+    if cache_graph and key in graph_cache:
+        # the target and the initial guess are fed when the variables are initialized
+        tfs, graph, session = graph_cache.pop(key)
+        tfs.sys_para = sys_para
+        print "Using cached graph"
+    else:
+        with tf.device(dev):
+            tfs = TensorflowState(sys_para) # create tensorflow graph
+            graph = tfs.build_graph()
+        if cache_graph:
+            session = tf.Session(graph=graph, config = session_config(sys_para,use_gpu))
+    if cache_graph:
+        graph_cache[key] = (tfs, graph, session)
+        while len(graph_cache) > graph_cache_size:
+            _, (_, _, old_session) = graph_cache.popitem(last=False)
+            old_session.close()
     
     conv = Convergence(sys_para,time_unit,convergence)
     
     # run the optimization
     try:
-        SS = run_session(tfs,graph,conv,sys_para,method, show_plots = sys_para.show_plots, use_gpu = use_gpu)
+        if batch:
+            # U is a list of target unitaries, the pulses and final unitaries are returned for each of them
+            SS = batch_run_session(tfs,graph,conv,sys_para,method, use_gpu = use_gpu, session = session)
+        elif multi_start is not None:
+            SS = batch_run_session(tfs,graph,conv,sys_para,method, use_gpu = use_gpu, session = session,
+                                   multi_start = True)
+            # the best start is returned
+            best_start = np.argmin(SS.l)
+            if save:
+                with H5File(file_path) as hf:
+                    hf.add('best_start',data=best_start)
+            SS.uks = SS.uks[best_start]
+            SS.Uf = SS.Uf[best_start]
+            SS.l = SS.l[best_start]
+            SS.needs_more_time = SS.needs_more_time[best_start]
+        else:
+            SS = run_session(tfs,graph,conv,sys_para,method, show_plots = sys_para.show_plots, use_gpu = use_gpu, session = session)
+        
+        if library is not None:
+            library.add(H0,Hops,maxA,register_size(len(H0)),total_time,U,SS.uks,SS.l,
+                        '' if file_path is None else file_path)
         
         # save wall clock time   
         if save:
@@ -126,7 +239,21 @@ def Grape(H0,Hops,Hnames,U,total_time,steps,states_concerned_list,convergence =
                 hf.add('wall_clock_time',data=np.array(wall_clock_time))
             print "data saved at: " + str(file_path)
         
-        return SS.uks,SS.Uf
+        result = (SS.uks,SS.Uf)
+        if return_error:
+            # final error of the optimization, for each target in batch mode
+            result += (SS.l,)
+        if return_status:
+            # True when the run was stopped as its loss does not reach the conv_target within max_iterations,
+            # so a longer total_time or more iterations are needed
+            result += (SS.needs_more_time,)
+        if return_error_trajectory:
+            # gate error after each time step of the pulses
+            result += (SS.error_trajectory,)
+        if return_file_path:
+            # data file of this optimization, None without save
+            result += (file_path,)
+        return result
     except KeyboardInterrupt:
         
         # save wall clock time   
@@ -0,0 +1,111 @@
+import unittest
+
+import numpy as np
+
+from quantum_optimal_control.core.convergence import Convergence
+
+
+class Parameters:
+    # the only system parameter the convergence settings read
+    show_plots = False
+
+
+def convergence(**settings):
+    return Convergence(Parameters(), 'ns', settings)
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def test_exponential(self):
+        conv = convergence(rate=0.1, learning_rate_decay=100)
+        self.assertAlmostEqual(conv.get_learning_rate(0), 0.1)
+        self.assertAlmostEqual(conv.get_learning_rate(100), 0.1 * np.exp(-1))
+
+    def test_cosine(self):
+        conv = convergence(rate=0.1, min_rate=0.01, schedule='cosine', max_iterations=100)
+        self.assertAlmostEqual(conv.get_learning_rate(0), 0.1)
+        self.assertAlmostEqual(conv.get_learning_rate(50), 0.055)
+        self.assertAlmostEqual(conv.get_learning_rate(100), 0.01)
+        self.assertAlmostEqual(conv.get_learning_rate(150), 0.01)
+
+    def test_warm_restarts(self):
+        # periods of 10 and 20 iterations, the rate is back to the full rate at the start of each period
+        conv = convergence(rate=0.1, schedule='warm_restarts', restart_period=10, restart_mult=2)
+        self.assertAlmostEqual(conv.get_learning_rate(0), 0.1)
+        self.assertAlmostEqual(conv.get_learning_rate(5), 0.05)
+        self.assertLess(conv.get_learning_rate(9), 0.01)
+        self.assertAlmostEqual(conv.get_learning_rate(10), 0.1)
+        self.assertAlmostEqual(conv.get_learning_rate(20), 0.05)
+        self.assertAlmostEqual(conv.get_learning_rate(30), 0.1)
+
+    def test_restart_schedule(self):
+        conv = convergence(rate=0.1, schedule='cosine', max_iterations=100)
+        conv.restart_schedule(50)
+        self.assertAlmostEqual(conv.get_learning_rate(50), 0.1)
+        self.assertAlmostEqual(conv.get_learning_rate(75), 0.05)
+
+    def test_plateau(self):
+        conv = convergence(rate=0.1, schedule='plateau', plateau_step=10, plateau_factor=0.5,
+                           plateau_threshold=1e-2, min_rate=0.02)
+        for iteration in range(10):
+            conv.update_schedule(iteration, 1.)
+        self.assertAlmostEqual(conv.get_learning_rate(9), 0.1)
+        conv.update_schedule(10, 1.)
+        self.assertAlmostEqual(conv.get_learning_rate(10), 0.05)
+        # an improvement smaller than plateau_threshold does not count
+        for iteration in range(11, 21):
+            conv.update_schedule(iteration, 0.995)
+        self.assertAlmostEqual(conv.get_learning_rate(20), 0.025)
+        for iteration in range(21, 31):
+            conv.update_schedule(iteration, 0.995)
+        self.assertAlmostEqual(conv.get_learning_rate(30), 0.02)
+
+    def test_stagnation(self):
+        conv = convergence(plateau_threshold=1e-2, stagnation_step=5)
+        self.assertFalse(conv.update_schedule(0, 1.))
+        self.assertFalse(conv.update_schedule(4, 1.))
+        self.assertFalse(conv.update_schedule(5, 0.9))
+        self.assertFalse(conv.update_schedule(9, 0.9))
+        self.assertTrue(conv.update_schedule(10, 0.9))
+
+
+class TrendTest(unittest.TestCase):
+    # exponential losses exp(-0.1 k) reach the conv_target 1e-8 after 184.2 iterations
+
+    def record(self, conv, losses):
+        for iteration, loss in enumerate(losses):
+            status = conv.needs_more_time(iteration, loss)
+        return status
+
+    def test_extrapolation(self):
+        conv = convergence(conv_target=1e-8, trend_step=10, max_iterations=200)
+        self.assertFalse(self.record(conv, np.exp(-0.1 * np.arange(10))))
+        self.assertAlmostEqual(conv.extrapolate_iterations(), (np.log(1e-8) + 0.9) / -0.1)
+
+    def test_budget(self):
+        losses = np.exp(-0.1 * np.arange(10))
+        self.assertFalse(self.record(convergence(conv_target=1e-8, trend_step=10, max_iterations=190), losses))
+        self.assertTrue(self.record(convergence(conv_target=1e-8, trend_step=10, max_iterations=180), losses))
+        self.assertFalse(self.record(convergence(conv_target=1e-8, trend_step=10, max_iterations=100,
+                                                 trend_margin=2.), losses))
+        # the trend needs trend_step losses
+        self.assertFalse(self.record(convergence(conv_target=1e-8, trend_step=10, max_iterations=10), losses[0:9]))
+
+    def test_history(self):
+        # only the last trend_step losses are fit, the flat start is forgotten
+        conv = convergence(conv_target=1e-8, trend_step=10, max_iterations=1000)
+        self.assertTrue(self.record(conv, np.ones(10)))
+        self.assertEqual(conv.extrapolate_iterations(), np.inf)
+        for iteration in range(10, 20):
+            status = conv.needs_more_time(iteration, np.exp(-0.1 * iteration))
+        self.assertEqual(len(conv.loss_history), 10)
+        self.assertFalse(status)
+
+    def test_batch(self):
+        conv = convergence(conv_target=1e-8, trend_step=10, max_iterations=200)
+        losses = np.transpose([np.exp(-0.1 * np.arange(10)), np.ones(10)])
+        np.testing.assert_array_equal(self.record(conv, losses), [False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
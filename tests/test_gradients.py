@@ -0,0 +1,112 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from quantum_optimal_control.core.system_parameters import SystemParameters
+from quantum_optimal_control.core.tensorflow_state import TensorflowState
+from quantum_optimal_control.compilation.hamiltonian import xy_hamiltonian_2D
+
+
+qubit_num = 2
+steps = 40
+total_time = 1.
+# entries of the weights that are checked against finite differences, as (control, step)
+checked_weights = [(0,0),(1,13),(2,39),(3,26)]
+# the unrolled propagation differentiates the step propagators to first order in dt,
+# its gradient is only compared to the exact one within this relative error
+first_order_rtol = 5e-2
+
+
+def build_graph(kron=False, **kwargs):
+    # 2 qubit x gate on the first qubit, in float64 so the finite differences are accurate
+    Hops, Hnames, maxA = xy_hamiltonian_2D(qubit_num,2,5,1,[(0,ii) for ii in range(qubit_num)],kron=kron)
+    H0 = np.zeros((2**qubit_num,2**qubit_num))
+    U = np.kron(np.array([[0,1],[1,0]]),np.identity(2**(qubit_num-1))).astype(complex)
+    U0 = np.identity(2**qubit_num)
+    np.random.seed(0)
+    initial_guess = 0.5*np.random.uniform(-1,1,[len(Hops),steps])*np.reshape(maxA,[-1,1])
+
+    sys_para = SystemParameters(H0,Hops,Hnames,U,U0,total_time,steps,range(2**qubit_num),None,maxA,None,initial_guess,
+                                False,1e-4,False,False,{},False,None,[6,2],False,True,False,False,False,'test',
+                                precision='float64',**kwargs)
+    tfs = TensorflowState(sys_para)
+    graph = tfs.build_graph()
+    return tfs, graph
+
+
+def loss_and_gradient(tfs, graph, eps=1e-5):
+    # loss, its gradient from tensorflow and the central finite differences of the checked weights
+    with graph.as_default():
+        gradient = tf.gradients(tfs.reg_loss,tfs.ops_weight_base)[0]
+        new_weights = tf.placeholder(tfs.ops_weight_base.dtype,tfs.ops_weight_base.shape)
+        assign = tfs.ops_weight_base.assign(new_weights)
+
+    config = tf.ConfigProto()
+    # grappler fails on the defun gradients of the matrix exponential
+    config.graph_options.rewrite_options.disable_meta_optimizer = True
+    with tf.Session(graph=graph,config=config) as session:
+        session.run(tfs.init_op,feed_dict=tfs.init_feed_dict())
+        weights = session.run(tfs.ops_weight_base)
+        loss, grad = session.run([tfs.reg_loss,gradient])
+
+        finite_difference = []
+        for ii, jj in checked_weights:
+            losses = []
+            for sign in [1,-1]:
+                shifted = weights.copy()
+                shifted[ii,jj] += sign*eps
+                session.run(assign,feed_dict={new_weights: shifted})
+                losses.append(session.run(tfs.reg_loss))
+            finite_difference.append((losses[0]-losses[1])/(2*eps))
+
+    return loss, grad, np.array(finite_difference)
+
+
+def assert_gradient_close(grad, expected, rtol):
+    # relative to the largest entry, the first order gradient is off by more on the small entries
+    np.testing.assert_allclose(grad,expected,rtol=0,atol=rtol*np.max(np.abs(expected)))
+
+
+class GradientTest(unittest.TestCase):
+    # every propagation mode has to give the loss of the unrolled propagation, and its gradient
+    # up to the first order approximation of the unrolled one
+
+    @classmethod
+    def setUpClass(cls):
+        cls.reference = loss_and_gradient(*build_graph(propagation='unrolled'))
+
+    def check_mode(self, exact=False, **kwargs):
+        loss, grad, finite_difference = loss_and_gradient(*build_graph(**kwargs))
+        reference_loss, reference_grad, _ = self.reference
+        checked_grad = np.array([grad[ii,jj] for ii, jj in checked_weights])
+
+        np.testing.assert_allclose(loss,reference_loss,rtol=1e-8)
+        if exact:
+            assert_gradient_close(checked_grad,finite_difference,1e-6)
+            assert_gradient_close(grad,reference_grad,first_order_rtol)
+        else:
+            assert_gradient_close(checked_grad,finite_difference,first_order_rtol)
+            assert_gradient_close(grad,reference_grad,1e-8)
+
+    def test_unrolled(self):
+        _, grad, finite_difference = self.reference
+        assert_gradient_close([grad[ii,jj] for ii, jj in checked_weights],finite_difference,first_order_rtol)
+
+    def test_adjoint(self):
+        self.check_mode(exact=True,propagation='adjoint')
+
+    def test_checkpoint(self):
+        # the steps are not a multiple of checkpoint_step, so the last segment is shorter
+        self.check_mode(propagation='unrolled',checkpoint_step=7)
+
+    def test_sparse_storage(self):
+        self.check_mode(propagation='unrolled',sparse_storage=True)
+        self.check_mode(propagation='unrolled',sparse_storage=True,complex_propagation=True)
+
+    def test_kron_operators(self):
+        self.check_mode(kron=True,propagation='unrolled',complex_propagation=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+import numpy as np
+
+from quantum_optimal_control.helper_functions.kron_operator import KronOperator
+from quantum_optimal_control.compilation.hamiltonian import xy_hamiltonian_2D, jj_hamiltonian_2D, \
+    zz_hamiltonian_2D, ion_trap_Hamiltonian, sc_Hamiltonian
+
+
+def embed(matrices, targets, subsystem_num, levels):
+    # dense operator of local matrices acting on single subsystems, with np.kron in the order of the subsystems
+    ops = [np.identity(levels)] * subsystem_num
+    for matrix, target in zip(matrices, targets):
+        ops[target] = matrix
+    M = ops[0]
+    for op in ops[1:]:
+        M = np.kron(M, op)
+    return M
+
+
+def random_matrix(dim):
+    return np.random.randn(dim, dim) + 1j * np.random.randn(dim, dim)
+
+
+class KronOperatorTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_single_subsystem_terms(self):
+        for levels in [2, 3]:
+            A, B = random_matrix(levels), random_matrix(levels)
+            op = KronOperator(3, levels, [(A, [1]), (B, [2])])
+            expected = embed([A], [1], 3, levels) + embed([B], [2], 3, levels)
+            np.testing.assert_allclose(op.full(), expected, atol=1e-12)
+
+    def test_target_order(self):
+        # the local matrix of a term acts on its targets in the order they are given, even when it is not the
+        # order of the subsystems
+        A, B = random_matrix(2), random_matrix(2)
+        op = KronOperator(3, 2, [(np.kron(A, B), [2, 0])])
+        np.testing.assert_allclose(op.full(), embed([A, B], [2, 0], 3, 2), atol=1e-12)
+
+    def test_dot(self):
+        M = random_matrix(4)
+        op = KronOperator(3, 2, [(M, [0, 2])]) + 2 * KronOperator(3, 2, [(random_matrix(2), [1])])
+        psi = np.random.randn(8) + 1j * np.random.randn(8)
+        Psi = np.random.randn(8, 5) + 1j * np.random.randn(8, 5)
+        np.testing.assert_allclose(op.dot(psi), np.dot(op.full(), psi), atol=1e-12)
+        np.testing.assert_allclose(op.dot(Psi), np.dot(op.full(), Psi), atol=1e-12)
+
+    def test_arithmetic(self):
+        A, B = random_matrix(2), random_matrix(2)
+        op = KronOperator(2, 2, [(A, [0])])
+        other = KronOperator(2, 2, [(B, [0])])
+        # terms on the same targets are merged
+        self.assertEqual(len((op + other).terms), 1)
+        np.testing.assert_allclose((op - other).full(), op.full() - other.full(), atol=1e-12)
+        np.testing.assert_allclose((0.5j * op).full(), 0.5j * op.full(), atol=1e-12)
+        self.assertGreaterEqual((op + other).max_abs(), np.max(np.abs((op + other).full())))
+
+    def test_from_dense(self):
+        M = random_matrix(4)
+        np.testing.assert_allclose(KronOperator.from_dense(M, 2).full(), M, atol=1e-12)
+        self.assertEqual(len(KronOperator.from_dense(np.zeros((4, 4)), 2).terms), 0)
+
+    def test_invalid_terms(self):
+        op = KronOperator(2)
+        self.assertRaises(ValueError, op.add_term, random_matrix(2), [2])
+        self.assertRaises(ValueError, op.add_term, random_matrix(4), [0, 0])
+        self.assertRaises(ValueError, op.add_term, random_matrix(2), [0, 1])
+
+    def test_hamiltonians(self):
+        mapping = [(0, 0), (0, 1), (1, 0)]
+        for function, args in [(xy_hamiltonian_2D, (3, 2, 5, 1, mapping)), (jj_hamiltonian_2D, (3, 2, 5, 1, mapping)),
+                               (zz_hamiltonian_2D, (3, 2, 5, 1, mapping)), (ion_trap_Hamiltonian, (3, 2, 5, 1)),
+                               (sc_Hamiltonian, (3, 2, 5, 1))]:
+            dense = function(*args)
+            kron = function(*args, kron=True)
+            self.assertEqual(dense[1], kron[1])
+            for M, op in zip(dense[0], kron[0]):
+                np.testing.assert_allclose(op.full(), M, atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from quantum_optimal_control.helper_functions.pulse_library import PulseLibrary, device_symmetries, \
+    remove_global_phase, target_fingerprint
+
+
+qubit_num = 3
+X = np.array([[0, 1], [1, 0]], dtype=complex)
+Y = np.array([[0, -1j], [1j, 0]], dtype=complex)
+Z = np.array([[1, 0], [0, -1]], dtype=complex)
+
+
+def qubit_op(op, qubit):
+    # op acting on one qubit of the register
+    ops = [np.identity(2)] * qubit_num
+    ops[qubit] = op
+    M = ops[0]
+    for ii in range(1, qubit_num):
+        M = np.kron(M, ops[ii])
+    return M
+
+
+def device(couplings=()):
+    # x and y controls on every qubit, with a zz drift on the couplings
+    H0 = np.zeros((2**qubit_num, 2**qubit_num), dtype=complex)
+    for ii, jj in couplings:
+        H0 = H0 + np.dot(qubit_op(Z, ii), qubit_op(Z, jj))
+    Hops = []
+    for ii in range(qubit_num):
+        Hops += [qubit_op(X, ii), qubit_op(Y, ii)]
+    return H0, Hops, [1.] * len(Hops)
+
+
+class SymmetryTest(unittest.TestCase):
+
+    def test_uncoupled_device(self):
+        H0, Hops, maxA = device()
+        self.assertEqual(len(device_symmetries(H0, Hops, maxA, qubit_num)), 6)
+
+    def test_chain(self):
+        # only the reflection of the chain leaves it invariant, and it swaps the controls of qubits 0 and 2
+        H0, Hops, maxA = device([(0, 1), (1, 2)])
+        symmetries = dict(device_symmetries(H0, Hops, maxA, qubit_num))
+        self.assertEqual(sorted(symmetries.keys()), [(0, 1, 2), (2, 1, 0)])
+        self.assertEqual(symmetries[(2, 1, 0)], [4, 5, 2, 3, 0, 1])
+
+    def test_generators(self):
+        # the given generators replace the transpositions, one rotation of the triangle generates the 3 rotations
+        H0, Hops, maxA = device([(0, 1), (1, 2), (2, 0)])
+        self.assertEqual(len(device_symmetries(H0, Hops, maxA, qubit_num, [(1, 2, 0)])), 3)
+        H0, Hops, maxA = device([(0, 1), (1, 2)])
+        self.assertRaises(ValueError, device_symmetries, H0, Hops, maxA, qubit_num, [(1, 2, 0)])
+
+    def test_global_phase(self):
+        U = qubit_op(X, 0)
+        np.testing.assert_allclose(remove_global_phase(np.exp(0.7j) * U), remove_global_phase(U))
+        H0, Hops, maxA = device()
+        symmetries = device_symmetries(H0, Hops, maxA, qubit_num)
+        self.assertEqual(target_fingerprint(np.exp(2.1j) * U, symmetries, qubit_num),
+                         target_fingerprint(qubit_op(X, 2), symmetries, qubit_num))
+
+
+class PulseLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, 'library.h5')
+        self.H0, self.Hops, self.maxA = device([(0, 1), (1, 2)])
+        # pulses of an x gate on qubit 0, only driving the x control of qubit 0
+        self.uks = np.zeros((len(self.Hops), 10))
+        self.uks[0] = 1.
+        library = PulseLibrary(self.file_path)
+        library.add(self.H0, self.Hops, self.maxA, qubit_num, 2., qubit_op(X, 0), self.uks, 1e-9)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def lookup(self, U, tolerance=1e-6, total_time=2.):
+        return PulseLibrary(self.file_path).lookup(self.H0, self.Hops, self.maxA, qubit_num, total_time, U, tolerance)
+
+    def test_phase_and_relabeling(self):
+        hit = self.lookup(np.exp(0.3j) * qubit_op(X, 0))
+        np.testing.assert_allclose(hit['uks'], self.uks)
+        # the x gate on qubit 2 is reached by the pulses on the x control of qubit 2
+        hit = self.lookup(qubit_op(X, 2))
+        np.testing.assert_allclose(hit['uks'][4], self.uks[0])
+        self.assertEqual(np.count_nonzero(hit['uks']), np.count_nonzero(self.uks))
+        # qubit 1 is not related to qubit 0 by a symmetry of the chain
+        self.assertIsNone(self.lookup(qubit_op(X, 1)))
+        self.assertIsNone(self.lookup(qubit_op(X, 0), total_time=3.))
+
+    def test_tolerance(self):
+        # the perturbation changes the fingerprint, its distance is of the order of its square
+        U = np.dot(qubit_op(X, 0), np.diag(np.exp(3e-4j * np.arange(2**qubit_num))))
+        symmetries = device_symmetries(self.H0, self.Hops, self.maxA, qubit_num)
+        self.assertNotEqual(target_fingerprint(U, symmetries, qubit_num),
+                            target_fingerprint(qubit_op(X, 0), symmetries, qubit_num))
+        hit = self.lookup(U)
+        self.assertIsNotNone(hit)
+        self.assertLess(hit['distance'], 1e-6)
+        self.assertIsNone(self.lookup(U, tolerance=1e-8))
+        self.assertIsNone(self.lookup(qubit_op(Y, 0)))
+
+    def test_set_symmetries(self):
+        library = PulseLibrary(self.file_path)
+        library.set_symmetries(self.H0, self.Hops, self.maxA, qubit_num, [])
+        self.assertIsNone(self.lookup(qubit_op(X, 2)))
+        self.assertIsNotNone(self.lookup(qubit_op(X, 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()